@@ -0,0 +1,141 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the cruise site, with the elements script_selenium.py looks for:
+# the "Login" button, the EMAIL/PASSWORD inputs, "Sign in", the logged in link,
+# the PLACEHOLDER element, the ship/port inputs, the SearchButton and the results filled by an XHR.
+
+SESSION_COOKIE = 'bench_session'
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>Cruises</title></head>
+<body>
+  <button id="login-button" onclick="document.getElementById('email').style.display='block'">Login</button>
+  <div id="email" style="display:none">
+    <input id="EMAIL" type="text">
+    <input id="PASSWORD" type="password">
+    <button id="sign-in" onclick="signIn()">Sign in</button>
+  </div>
+  <script>
+    function signIn() {
+      document.cookie = "%(cookie)s=" + Date.now() + "; path=/";
+      window.location.href = "/";
+    }
+  </script>
+</body></html>
+"""
+
+SEARCH_PAGE = """<!DOCTYPE html>
+<html><head><title>Cruises</title>
+<style>
+  body { font-family: sans-serif; margin: 0; padding: 16px; }
+  .row { height: 48px; border-bottom: 1px solid #ddd; display: flex; align-items: center; }
+</style></head>
+<body>
+  <a href="#">Find some html element before proceeding</a>
+  <div id="PLACEHOLDER" onclick="loadFilters()">Select your cruise</div>
+  <input id="ship" type="text" placeholder="Ship">
+  <input id="port" type="text" placeholder="Port of departure">
+  <button data="SearchButton" onclick="search()">Modify search</button>
+  <div data="PLACEHOLDER"></div>
+  <div id="filler"></div>
+  <script>
+    function loadFilters() {
+      fetch("/api/filters").then(function(r) { return r.json(); });
+    }
+    function search() {
+      var query = "ship=" + encodeURIComponent(document.getElementById("ship").value) +
+                  "&port=" + encodeURIComponent(document.getElementById("port").value);
+      fetch("/api/cruise-search?" + query).then(function(r) { return r.json(); }).then(function(data) {
+        var results = document.querySelector("div[data='PLACEHOLDER']");
+        results.innerHTML = data.cruises.map(function(c) {
+          return '<div class="row">' + c.shipName + ' from ' + c.portOfDeparture + ' on ' + c.departureDate +
+                 ' - ' + c.price + ' ' + c.currency + '</div>';
+        }).join('');
+        document.getElementById("filler").style.height = Math.max(0, %(page_height)d - document.body.scrollHeight) + "px";
+      });
+    }
+  </script>
+</body></html>
+"""
+
+
+class FakeSiteConfig:
+    def __init__(self, xhr_delay=0.5, page_height=4000, rows=30, vary=True):
+        self.xhr_delay = xhr_delay  # Seconds the filter and search XHRs take to answer
+        self.page_height = page_height  # Height in pixels of the page with the results
+        self.rows = rows  # Cruises returned by a search
+        self.vary = vary  # Random prices on every search, so that every page looks changed
+
+
+def make_handler(config):
+    class FakeSiteHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path
+            if path == '/':
+                logged_in = f"{SESSION_COOKIE}=" in self.headers.get('Cookie', '')
+                page = SEARCH_PAGE % {'page_height': config.page_height} if logged_in else LOGIN_PAGE % {'cookie': SESSION_COOKIE}
+                self._send(page.encode('utf-8'), 'text/html; charset=utf-8')
+            elif path == '/api/filters':
+                time.sleep(config.xhr_delay)
+                self._send_json({'ships': ['MSC World Europa', 'MSC Seaside', 'MSC Meraviglia']})
+            elif path == '/api/cruise-search':
+                time.sleep(config.xhr_delay)
+                query = parse_qs(url.query)
+                self._send_json({'cruises': self._cruises(query.get('ship', [''])[0], query.get('port', [''])[0])})
+            else:
+                self.send_error(404)
+
+        def _cruises(self, ship_name, port_of_departure):
+            rng = random.Random() if config.vary else random.Random(42)
+            return [{
+                'shipName': ship_name,
+                'portOfDeparture': port_of_departure,
+                'departureDate': f"2027-{1 + i % 12:02d}-{1 + i % 28:02d}",
+                'returnDate': f"2027-{1 + i % 12:02d}-{8 + i % 20:02d}",
+                'price': round(rng.uniform(400, 2500), 2),
+                'currency': 'EUR',
+            } for i in range(config.rows)]
+
+        def _send_json(self, data):
+            self._send(json.dumps(data).encode('utf-8'), 'application/json')
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeSiteHandler
+
+
+def start_fake_site(config, host='127.0.0.1', port=0):
+    """Start the fake site on a daemon thread and return the server; port 0 picks a free one."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    threading.Thread(target=server.serve_forever, name='fake-site', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fake cruise site")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--xhr-delay', type=float, default=0.5)
+    parser.add_argument('--page-height', type=int, default=4000)
+    args = parser.parse_args()
+    server = start_fake_site(FakeSiteConfig(args.xhr_delay, args.page_height), port=args.port)
+    print(f"Fake cruise site on http://127.0.0.1:{server.server_address[1]}/")
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import itertools
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the Telegram Bot API, enough for telegram_bot_conn.py to run with
+# TELEGRAM_BASE_URL pointing at it: commands are handed out by getUpdates and every
+# send is recorded with its size, so that the benchmark can tell when a user got the answer.
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+
+
+class Send:
+    """A request of the bot to a chat."""
+
+    def __init__(self, chat_id, method, size, at):
+        self.chat_id = chat_id
+        self.method = method
+        self.size = size  # Bytes of the request body
+        self.at = at
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.sends = []
+        self.bytes_received = 0
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._polled = threading.Event()
+        self._changed = threading.Condition()
+
+    def push_command(self, chat_id, text):
+        """Queue a command from the user `chat_id` for the next getUpdates, returns when it was queued."""
+        command = text.split()[0]
+        with self._changed:
+            self._updates.append({
+                'update_id': next(self._update_ids),
+                'message': {
+                    'message_id': next(self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': f"User {chat_id}"},
+                    'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+                },
+            })
+            self._changed.notify_all()
+            return time.monotonic()
+
+    def wait_until_polled(self, timeout):
+        """True once the bot has called getUpdates, i.e. it is ready to receive commands."""
+        return self._polled.wait(timeout)
+
+    def wait_for_send(self, chat_id, methods, since, timeout):
+        """Time of the first send of one of `methods` to the chat after `since`, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                for send in self.sends:
+                    if send.chat_id == chat_id and send.method in methods and send.at >= since:
+                        return send.at
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def handle(self, method, params, size):
+        self.bytes_received += size
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        if 'chat_id' not in params:
+            return True
+
+        chat_id = int(params['chat_id'])
+        with self._changed:
+            self.sends.append(Send(chat_id, method, size, time.monotonic()))
+            self._changed.notify_all()
+        if method == 'sendMediaGroup':
+            return [self._message(chat_id, self._attachment('sendPhoto')) for _ in json.loads(params['media'])]
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument'):
+            return self._message(chat_id, self._attachment(method, params.get('text')))
+        return True
+
+    def _get_updates(self, offset, timeout):
+        self._polled.set()
+        deadline = time.monotonic() + min(timeout, 10)
+        with self._changed:
+            while True:
+                updates = [update for update in self._updates if update['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if updates or remaining <= 0:
+                    # Confirmed updates are dropped, like the real API does
+                    self._updates = updates
+                    return updates
+                self._changed.wait(remaining)
+
+    def _attachment(self, method, text=None):
+        file_id = f"file-{next(self._file_ids)}"
+        if method == 'sendPhoto':
+            return {'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 2000}]}
+        if method == 'sendDocument':
+            return {'document': {'file_id': file_id, 'file_unique_id': file_id}}
+        return {'text': text or ''}
+
+    def _message(self, chat_id, content):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            **content,
+        }
+
+
+def parse_params(content_type, body):
+    """Parameters of a Bot API request, sent as JSON, urlencoded or multipart form."""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in message.iter_parts():
+            if part.get_filename() is None:
+                params[part.get_param('name', header='content-disposition')] = part.get_content()
+        return params
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+
+def make_handler(telegram):
+    class FakeTelegramHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self._answer(body)
+
+        def do_GET(self):
+            self._answer(b'')
+
+        def _answer(self, body):
+            url = urlparse(self.path)
+            method = url.path.rstrip('/').rsplit('/', 1)[-1]
+            params = parse_params(self.headers.get('Content-Type', ''), body)
+            params.update({key: values[0] for key, values in parse_qs(url.query).items()})
+            try:
+                reply = {'ok': True, 'result': telegram.handle(method, params, len(body))}
+            except Exception as e:
+                reply = {'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"}
+            data = json.dumps(reply).encode('utf-8')
+            self.send_response(200 if reply['ok'] else 400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeTelegramHandler
+
+
+def start_fake_telegram(telegram, host='127.0.0.1', port=0):
+    """Serve `telegram` on a daemon thread, the bot must use http://host:port/bot as TELEGRAM_BASE_URL."""
+    server = ThreadingHTTPServer((host, port), make_handler(telegram))
+    threading.Thread(target=server.serve_forever, name='fake-telegram', daemon=True).start()
+    return server
@@ -0,0 +1,155 @@
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_site import FakeSiteConfig, start_fake_site
+from fake_telegram import FakeTelegram, start_fake_telegram
+
+# Offline end-to-end benchmark: runs telegram_bot_conn.py against the fake cruise site and the
+# fake Bot API, drives N simulated users through /screenshot and reports the throughput,
+# the latency percentiles, the memory of the browsers and the bytes sent to Telegram.
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'telegram_bot_conn.py')
+COMBINATIONS = [('MSC World Europa', 'Genoa'), ('MSC Seaside', 'Barcelona'), ('MSC Meraviglia', 'Miami')]
+REPLY_METHODS = {'sendPhoto', 'sendMediaGroup', 'sendDocument'}
+
+
+class MemorySampler(threading.Thread):
+    """Peak resident memory of the Chrome processes, read from /proc (Linux only)."""
+
+    def __init__(self, interval=0.5):
+        super().__init__(name='memory-sampler', daemon=True)
+        self.interval = interval
+        self.peak_mb = None
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            used = self.browser_rss_mb()
+            if used is not None:
+                self.peak_mb = max(self.peak_mb or 0, used)
+
+    def stop(self):
+        self._done.set()
+
+    @staticmethod
+    def browser_rss_mb():
+        if not os.path.isdir('/proc'):
+            return None
+        total_kb = 0
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open(f"/proc/{pid}/comm") as f:
+                    if 'chrome' not in f.read():
+                        continue
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total_kb += int(line.split()[1])
+            except OSError:
+                continue
+        return total_kb / 1024
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def simulate_user(telegram, chat_id, requests, fresh, timeout, latencies, timeouts):
+    for i in range(requests):
+        ship, port = COMBINATIONS[(chat_id + i) % len(COMBINATIONS)]
+        command = f"/screenshot {ship}-{port}" + (" --fresh" if fresh else "")
+        since = telegram.push_command(chat_id, command)
+        answered = telegram.wait_for_send(chat_id, REPLY_METHODS, since, timeout)
+        if answered is None:
+            timeouts.append(chat_id)
+        else:
+            latencies.append(answered - since)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a fake cruise site and a fake Bot API")
+    parser.add_argument('--users', type=int, default=5, help="Simulated users sending commands at the same time")
+    parser.add_argument('--requests', type=int, default=3, help="/screenshot commands sent by every user, one after the other")
+    parser.add_argument('--xhr-delay', type=float, default=0.5, help="Seconds the XHRs of the fake site take")
+    parser.add_argument('--page-height', type=int, default=4000, help="Height in pixels of the results page")
+    parser.add_argument('--cached', action='store_true', help="Let the bot answer from its result cache")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds a user waits for the screenshot")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra variable for the bot, e.g. --env DRIVER_POOL_SIZE=4")
+    parser.add_argument('--bot-log', help="File receiving the output of the bot, discarded by default")
+    args = parser.parse_args()
+
+    site = start_fake_site(FakeSiteConfig(args.xhr_delay, args.page_height))
+    telegram = FakeTelegram()
+    api = start_fake_telegram(telegram)
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_API_TOKEN': '123456:benchmark',
+        'TELEGRAM_BASE_URL': f"http://127.0.0.1:{api.server_address[1]}/bot",
+        'TARGET_URL': f"http://127.0.0.1:{site.server_address[1]}/",
+        'USER': 'benchmark@example.com',
+        'PASSWORD': 'benchmark',
+        'HEADLESS': 'true',
+        'SELENIUM_REMOTE_URLS': '',
+        'PRECOMPUTE_ENABLED': 'false',
+        'BOT_MODE': 'polling',
+        'SCRAPE_MODE': 'inprocess',
+    })
+    env.update(item.split('=', 1) for item in args.env)
+
+    output = open(args.bot_log, 'w') if args.bot_log else subprocess.DEVNULL
+    # The bot runs in a scratch folder, so its sessions, caches and logs do not touch the checkout
+    bot = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT)
+    sampler = MemorySampler()
+    try:
+        print(f"Waiting for the bot to start (work folder {workdir})...")
+        if not telegram.wait_until_polled(timeout=300):
+            raise SystemExit("The bot did not start polling within 5 minutes")
+        sampler.start()
+
+        latencies, timeouts = [], []
+        bytes_before = telegram.bytes_received
+        started = time.monotonic()
+        users = [threading.Thread(target=simulate_user,
+                                  args=(telegram, 1000 + i, args.requests, not args.cached, args.timeout, latencies, timeouts))
+                 for i in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.monotonic() - started
+    finally:
+        sampler.stop()
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        site.shutdown()
+        api.shutdown()
+
+    latencies.sort()
+    sent_bytes = telegram.bytes_received - bytes_before
+    print(f"Users: {args.users}, requests per user: {args.requests}, XHR delay: {args.xhr_delay}s, "
+          f"page height: {args.page_height}px, cache: {'on' if args.cached else 'off'}")
+    print(f"Answered {len(latencies)} of {args.users * args.requests} requests in {elapsed:.1f}s "
+          f"({len(latencies) / elapsed:.2f} requests/s), {len(timeouts)} timed out")
+    if latencies:
+        print(f"Latency: mean {statistics.mean(latencies):.2f}s, p50 {percentile(latencies, 0.5):.2f}s, "
+              f"p95 {percentile(latencies, 0.95):.2f}s, p99 {percentile(latencies, 0.99):.2f}s, max {latencies[-1]:.2f}s")
+    print(f"Bytes sent to Telegram: {sent_bytes} ({sent_bytes / max(1, len(latencies)) / 1024:.0f} KB per answer)")
+    if sampler.peak_mb is not None:
+        print(f"Peak browser memory: {sampler.peak_mb:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
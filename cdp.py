@@ -0,0 +1,47 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def execute_cdp(driver, cmd, params=None):
+    """Send a Chrome DevTools Protocol command through the WebDriver session, local or on a Grid."""
+    if hasattr(driver, 'execute_cdp_cmd'):
+        return driver.execute_cdp_cmd(cmd, params or {})
+    # webdriver.Remote has no helper, but Chrome nodes expose the same endpoint
+    commands = driver.command_executor._commands
+    if 'executeCdpCommand' not in commands:
+        commands['executeCdpCommand'] = ('POST', '/session/$sessionId/goog/cdp/execute')
+    return driver.execute('executeCdpCommand', {'cmd': cmd, 'params': params or {}})['value']
+
+
+def read_performance_events(driver):
+    """
+    Drain the performance log of the browser and return its DevTools events.
+    The driver must be created with the 'goog:loggingPrefs' performance capability.
+    """
+    return [event for _, event in _read_performance_log(driver)]
+
+
+def read_performance_events_by_target(driver):
+    """Like read_performance_events, as {target id of the tab: events}, for browsers with several tabs."""
+    events = {}
+    for target_id, event in _read_performance_log(driver):
+        events.setdefault(target_id, []).append(event)
+    return events
+
+
+def current_target_id(driver):
+    """DevTools target id of the tab the driver is switched to."""
+    return execute_cdp(driver, "Target.getTargetInfo")['targetInfo']['targetId']
+
+
+def _read_performance_log(driver):
+    entries = []
+    for entry in driver.get_log('performance'):
+        try:
+            message = json.loads(entry['message'])
+            entries.append((message.get('webview'), message['message']))
+        except (KeyError, ValueError) as e:
+            logger.debug(f"Skipping malformed performance log entry: {e}")
+    return entries
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import math
+import os
+from dataclasses import asdict
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageDraw
+
+from image_tiles import encode_image
+
+logger = logging.getLogger(__name__)
+
+# Perceptual hashes closer than this many bits are considered the same page
+IMAGE_HASH_THRESHOLD = int(os.getenv('IMAGE_HASH_THRESHOLD', '6'))
+# Draw a box around the regions which changed since the previous result
+CHANGE_HIGHLIGHT = os.getenv('CHANGE_HIGHLIGHT', 'false').lower() == 'true'
+
+HASH_SIZE = 16  # The difference hash has HASH_SIZE * HASH_SIZE bits
+HIGHLIGHT_CELL = 32  # Pixels of the grid used to locate the changes
+HIGHLIGHT_MIN_DIFFERENCE = 24  # Mean difference of a cell, out of 255, above which it counts as changed
+
+
+def content_hash(text, records):
+    """Hash of what the user reads: the text of the results and the parsed cruises."""
+    digest = hashlib.sha256()
+    digest.update((text or '').encode('utf-8'))
+    digest.update(json.dumps([asdict(record) for record in records], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def image_hash(image_bytes):
+    """Difference hash of an image, as hex: similar images have hashes a few bits apart."""
+    image = Image.open(BytesIO(image_bytes)).convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def is_unchanged(previous, new_content_hash, new_image_hash, threshold=IMAGE_HASH_THRESHOLD):
+    """Compare the fingerprint of a new page with the previous ScrapeResult of the same combination."""
+    if previous is None or not previous.images or previous.content_hash is None or previous.image_hash is None:
+        return False
+    if previous.content_hash != new_content_hash:
+        return False
+    distance = hamming_distance(previous.image_hash, new_image_hash)
+    logger.debug(f"Perceptual distance from the previous result: {distance} bits")
+    return distance <= threshold
+
+
+def highlight_changes(previous_images, images, fmt):
+    """
+    Return the new tiles with a red box around the cells which differ from the previous tiles.
+    Tiles which cannot be compared, e.g. because the page height changed, are returned as they are.
+    """
+    highlighted = []
+    for i, data in enumerate(images):
+        if i >= len(previous_images):
+            highlighted.append(data)
+            continue
+        new = Image.open(BytesIO(data)).convert('RGB')
+        old = Image.open(BytesIO(previous_images[i])).convert('RGB')
+        if new.size != old.size:
+            highlighted.append(data)
+            continue
+        # Box filtering the difference down to one pixel per cell gives the mean difference of every cell
+        columns = math.ceil(new.width / HIGHLIGHT_CELL)
+        rows = math.ceil(new.height / HIGHLIGHT_CELL)
+        cells = ImageChops.difference(new, old).convert('L').resize((columns, rows), Image.BOX)
+        draw = ImageDraw.Draw(new)
+        changed = False
+        for row in range(rows):
+            for col in range(columns):
+                if cells.getpixel((col, row)) > HIGHLIGHT_MIN_DIFFERENCE:
+                    left, top = col * HIGHLIGHT_CELL, row * HIGHLIGHT_CELL
+                    box = (left, top, min(left + HIGHLIGHT_CELL, new.width) - 1, min(top + HIGHLIGHT_CELL, new.height) - 1)
+                    draw.rectangle(box, outline=(255, 0, 0), width=3)
+                    changed = True
+        highlighted.append(encode_image(new, fmt) if changed else data)
+    return highlighted
@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+import time
+
+from metrics import increment
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # Failed scrapes in a row which open the circuit
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '60'))  # Seconds the circuit stays open before a probe scrape
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of scraping while the target site is considered down."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"The target site is degraded, next attempt in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops sending browsers to a site which keeps failing.
+
+    After `failure_threshold` failures in a row the circuit opens and every scrape is refused
+    for `reset_timeout` seconds. Then a single probe scrape is let through (half open): its
+    success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name='site', failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False  # A half open probe is running
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._retry_after() <= 0:
+                return HALF_OPEN
+            return self._state
+
+    def is_open(self):
+        """True while scrapes are refused, without taking the probe slot."""
+        with self._lock:
+            if self._state == OPEN:
+                return self._retry_after() > 0 or self._probing
+            return self._state == HALF_OPEN and self._probing
+
+    def retry_after(self):
+        """Seconds before the next probe, 0 when scrapes are let through."""
+        with self._lock:
+            return self._retry_after() if self._state == OPEN else 0
+
+    def check(self):
+        """Let a scrape through, or raise CircuitOpen. A scrape let through must end in one of the record_ calls."""
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN:
+                if self._retry_after() > 0:
+                    raise CircuitOpen(self._retry_after())
+                self._state = HALF_OPEN
+            if self._probing:
+                raise CircuitOpen(self.reset_timeout)
+            self._probing = True
+            logger.info(f"Circuit of the {self.name} half open, probing with one scrape")
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"Circuit of the {self.name} closed, the probe scrape succeeded")
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                increment('circuit_opened_total', circuit=self.name)
+                logger.warning(f"Circuit of the {self.name} open after {self._failures} failures in a row, "
+                               f"scrapes refused for {self.reset_timeout:.0f}s")
+
+    def record_cancelled(self):
+        """A scrape let through was cancelled: it proves nothing, so a new probe may run."""
+        with self._lock:
+            self._probing = False
+
+    def _retry_after(self):
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
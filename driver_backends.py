@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+
+from metrics import timer
+
+logger = logging.getLogger(__name__)
+
+# Comma separated Grid/standalone endpoints, e.g. http://selenium:4444; empty to launch Chrome locally
+SELENIUM_REMOTE_URLS = os.getenv('SELENIUM_REMOTE_URLS', '')
+# Seconds an unhealthy node is left alone before being checked again
+NODE_RETRY_AFTER = int(os.getenv('SELENIUM_NODE_RETRY_AFTER', '30'))
+# Pinned chromedriver binary; when set it is used as is and nothing is downloaded
+CHROMEDRIVER_PATH = os.getenv('CHROMEDRIVER_PATH', '')
+# Where the chromedriver path found by webdriver-manager is remembered across restarts
+CHROMEDRIVER_CACHE_FILE = os.getenv('CHROMEDRIVER_CACHE_FILE', 'cache/chromedriver.json')
+# Seconds after which webdriver-manager is asked again, to follow the updates of Chrome
+CHROMEDRIVER_CACHE_MAX_AGE = int(os.getenv('CHROMEDRIVER_CACHE_MAX_AGE', str(24 * 3600)))
+
+
+class LocalChromeBackend:
+    """
+    Launches Chrome on the machine running the bot.
+
+    The chromedriver path is resolved once per process: the pinned CHROMEDRIVER_PATH,
+    else the path remembered in CHROMEDRIVER_CACHE_FILE, else webdriver-manager, which
+    checks the installed Chrome version and may download a driver.
+    """
+
+    def __init__(self, driver_path=CHROMEDRIVER_PATH, cache_file=CHROMEDRIVER_CACHE_FILE,
+                 cache_max_age=CHROMEDRIVER_CACHE_MAX_AGE):
+        self.cache_file = cache_file
+        self.cache_max_age = cache_max_age
+        self._driver_path = driver_path or None
+        self._from_cache = False  # True while the path comes from the cache file and was not checked by webdriver-manager
+        self._lock = threading.Lock()
+
+    def driver_path(self):
+        with self._lock:
+            if self._driver_path is None:
+                self._driver_path = self._resolve_driver_path()
+            return self._driver_path
+
+    def create(self, options):
+        driver_path = self.driver_path()
+        try:
+            with timer('scrape_stage_seconds', stage='browser_start'):
+                return webdriver.Chrome(service=Service(driver_path), options=options)
+        except Exception as e:
+            if not self._from_cache:
+                raise
+            # Chrome may have been updated since the driver was cached, ask webdriver-manager again
+            logger.warning(f"Cached chromedriver {driver_path} failed to start Chrome ({e}), resolving it again")
+            with self._lock:
+                self._driver_path = self._resolve_driver_path(use_cache=False)
+            with timer('scrape_stage_seconds', stage='browser_start'):
+                return webdriver.Chrome(service=Service(self._driver_path), options=options)
+
+    def release(self, driver):
+        driver.quit()
+
+    def _resolve_driver_path(self, use_cache=True):
+        if use_cache:
+            try:
+                with open(self.cache_file) as f:
+                    cached = json.load(f)
+                if os.path.exists(cached['path']) and time.time() - cached['resolved_at'] < self.cache_max_age:
+                    logger.debug(f"Using the cached chromedriver {cached['path']}")
+                    self._from_cache = True
+                    return cached['path']
+            except (OSError, ValueError, KeyError):
+                pass
+        self._from_cache = False
+
+        with timer('scrape_stage_seconds', stage='driver_install'):
+            path = ChromeDriverManager().install()
+        try:
+            folder = os.path.dirname(self.cache_file)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(self.cache_file, 'w') as f:
+                json.dump({'path': path, 'resolved_at': time.time()}, f)
+        except OSError as e:
+            logger.debug(f"Unable to remember the chromedriver path: {e}")
+        logger.info(f"Resolved chromedriver {path}")
+        return path
+
+
+class GridNode:
+    """A Selenium Grid hub or standalone server and the sessions the bot has open on it."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.active = 0
+        self.healthy = True
+        self.retry_at = 0
+
+    def free_slots(self, timeout=3):
+        """Free browser slots reported by the /status endpoint, None if the node does not answer."""
+        try:
+            with urllib.request.urlopen(f"{self.url}/status", timeout=timeout) as response:
+                status = json.load(response)['value']
+        except Exception as e:
+            logger.debug(f"Node {self.url} did not answer the status check: {e}")
+            return None
+        if not status.get('ready'):
+            return 0
+        nodes = status.get('nodes')
+        if not nodes:
+            # A standalone server only says whether it can start a new session
+            return 1
+        return sum(1 for node in nodes for slot in node.get('slots', []) if not slot.get('session'))
+
+
+class RemoteGridBackend:
+    """
+    Opens browsers on one or more Selenium Grid/standalone endpoints.
+
+    New sessions go to the node with the most free slots, and to the one where
+    the bot has the fewest sessions on a tie. A node which fails is skipped for
+    NODE_RETRY_AFTER seconds and the session is opened on the next one.
+    """
+
+    def __init__(self, urls):
+        self.nodes = [GridNode(url) for url in urls]
+        self._sessions = {}  # WebDriver session id -> GridNode
+        self._lock = threading.Lock()
+
+    def add_node(self, url):
+        with self._lock:
+            self.nodes.append(GridNode(url))
+
+    def create(self, options):
+        errors = []
+        for node in self._candidates():
+            with self._lock:
+                node.active += 1
+            try:
+                with timer('scrape_stage_seconds', stage='browser_start'):
+                    driver = webdriver.Remote(command_executor=node.url, options=options)
+            except Exception as e:
+                with self._lock:
+                    node.active -= 1
+                self._mark_unhealthy(node)
+                errors.append(f"{node.url}: {e}")
+                continue
+            with self._lock:
+                self._sessions[driver.session_id] = node
+            logger.debug(f"Browser opened on {node.url} ({node.active} sessions of the bot)")
+            return driver
+        raise RuntimeError("No Selenium node could open a browser: " + "; ".join(errors or ["no healthy node"]))
+
+    def release(self, driver):
+        with self._lock:
+            node = self._sessions.pop(driver.session_id, None)
+            if node is not None:
+                node.active -= 1
+        driver.quit()
+
+    def _candidates(self):
+        now = time.monotonic()
+        with self._lock:
+            nodes = [n for n in self.nodes if n.healthy or n.retry_at <= now]
+        ranked = []
+        for node in nodes:
+            free = node.free_slots()
+            if free is None:
+                self._mark_unhealthy(node)
+                continue
+            node.healthy = True
+            ranked.append((free, -node.active, node))
+        ranked.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return [node for free, _, node in ranked if free > 0] + [node for free, _, node in ranked if free <= 0]
+
+    def _mark_unhealthy(self, node):
+        logger.warning(f"Selenium node {node.url} is unhealthy, skipping it for {NODE_RETRY_AFTER}s")
+        node.healthy = False
+        node.retry_at = time.monotonic() + NODE_RETRY_AFTER
+
+
+def create_backend_from_env():
+    """RemoteGridBackend when SELENIUM_REMOTE_URLS is set, LocalChromeBackend otherwise."""
+    urls = [url.strip() for url in SELENIUM_REMOTE_URLS.split(',') if url.strip()]
+    if urls:
+        return RemoteGridBackend(urls)
+    return LocalChromeBackend()
@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import timer
+
+logger = logging.getLogger(__name__)
+
+
+class PooledDriver:
+    """A WebDriver kept alive by the DriverPool together with its usage bookkeeping."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+        self.created_at = time.monotonic()
+
+
+class DriverPool:
+    """
+    Keeps a fixed number of pre-launched, already logged-in browsers.
+
+    The factory is called whenever a new browser is needed and must return a
+    ready to use WebDriver, `destroy` is called to close it. Drivers are
+    borrowed with checkout() and given back with checkin(); the session()
+    context manager does both.
+    """
+
+    def __init__(self, factory, size=2, max_uses=20, max_memory_mb=512, destroy=None):
+        self.factory = factory
+        self.destroy = destroy or (lambda driver: driver.quit())
+        self.size = size
+        self.max_uses = max_uses
+        self.max_memory_mb = max_memory_mb
+        self._idle = []
+        self._total = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def warm(self):
+        """Launch browsers until the pool holds `size` of them."""
+        while True:
+            with self._lock:
+                if self._closed or self._total >= self.size:
+                    return
+                self._total += 1
+            pooled = self._create()
+            with self._lock:
+                if pooled is None:
+                    self._total -= 1
+                    return
+                self._idle.append(pooled)
+                self._lock.notify()
+
+    def checkout(self, timeout=None):
+        """Borrow a healthy driver, waiting up to `timeout` seconds if they are all busy."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("The driver pool is closed")
+                pooled = None
+                create = False
+                if self._idle:
+                    pooled = self._idle.pop()
+                elif self._total < self.size:
+                    self._total += 1
+                    create = True
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No browser available in the driver pool")
+                    self._lock.wait(remaining)
+                    continue
+
+            if create:
+                pooled = self._create()
+                if pooled is None:
+                    with self._lock:
+                        self._total -= 1
+                        self._lock.notify()
+                    raise RuntimeError("Unable to launch a browser for the driver pool")
+                return pooled
+
+            if self.is_healthy(pooled):
+                return pooled
+            logger.debug("Discarding an unhealthy pooled driver")
+            self._discard(pooled)
+
+    def checkin(self, pooled, discard=False):
+        """Give a driver back to the pool, replacing it with a new one if it is worn out or broken."""
+        pooled.uses += 1
+        if discard or self._closed or self._needs_recycle(pooled):
+            self._discard(pooled)
+            return
+        with self._lock:
+            self._idle.append(pooled)
+            self._lock.notify()
+
+    @contextmanager
+    def session(self, timeout=None):
+        """Borrow a driver for the duration of a with block."""
+        with timer('scrape_stage_seconds', stage='driver_checkout'):
+            pooled = self.checkout(timeout)
+        failed = False
+        try:
+            yield pooled.driver
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            # A driver that raised mid-flow may be sitting on an unknown page, so don't reuse it
+            self.checkin(pooled, discard=failed)
+
+    def is_healthy(self, pooled):
+        try:
+            pooled.driver.execute_script("return 1")
+            return len(pooled.driver.window_handles) > 0
+        except Exception as e:
+            logger.debug(f"Health check failed: {e}")
+            return False
+
+    def close(self):
+        """Quit every idle browser; busy ones are quit when they are checked in."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+    def _needs_recycle(self, pooled):
+        if self.max_uses and pooled.uses >= self.max_uses:
+            logger.debug(f"Recycling driver after {pooled.uses} uses")
+            return True
+        if self.max_memory_mb:
+            used_mb = self._memory_mb(pooled)
+            if used_mb is not None and used_mb >= self.max_memory_mb:
+                logger.debug(f"Recycling driver using {used_mb:.0f} MB of JS heap")
+                return True
+        return False
+
+    def _memory_mb(self, pooled):
+        # Chrome only exposes the JS heap of the page, which is a good enough proxy for a leaking tab
+        try:
+            used = pooled.driver.execute_script(
+                "return window.performance && performance.memory ? performance.memory.usedJSHeapSize : null")
+        except Exception:
+            return None
+        return None if used is None else used / (1024 * 1024)
+
+    def _create(self):
+        try:
+            return PooledDriver(self.factory())
+        except Exception as e:
+            logger.error(f"Unable to create a pooled driver: {e}")
+            return None
+
+    def _discard(self, pooled):
+        try:
+            self.destroy(pooled.driver)
+        except Exception as e:
+            logger.debug(f"Error while quitting a pooled driver: {e}")
+        with self._lock:
+            self._total -= 1
+            self._lock.notify()
+            refill = not self._closed
+        if refill:
+            # Launch the replacement in the background, so the next checkout finds a browser ready
+            threading.Thread(target=self.warm, name='driver-pool-refill', daemon=True).start()
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    Maps the hash of an image already uploaded to Telegram to the file_id it got,
+    so that sending the same bytes again only sends the reference.
+
+    Photos and documents get different file_ids, so the kind is part of the key.
+    Entries older than `ttl` seconds are not used, the least recently used ones are
+    evicted past `max_entries`, and the map is persisted as JSON.
+    """
+
+    def __init__(self, path="data/file_ids.json", ttl=30 * 24 * 3600, max_entries=2000):
+        self.path = path  # None keeps the cache in memory only
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (file_id, stored_at)
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                for item in json.load(f):
+                    self._entries[item['key']] = (item['file_id'], item['stored_at'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def key(image, kind):
+        return f"{kind}:{hashlib.sha256(image).hexdigest()}"
+
+    def get(self, image, kind):
+        """file_id of an identical image sent before as `kind` ('photo' or 'document'), or None."""
+        key = self.key(image, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, image, kind, file_id):
+        key = self.key(image, kind)
+        with self._lock:
+            if self._entries.get(key, (None,))[0] == file_id:
+                return
+            self._entries[key] = (file_id, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def invalidate(self, file_id):
+        """Forget a file_id which Telegram refused."""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[0] == file_id]
+            for key in keys:
+                del self._entries[key]
+            if keys:
+                self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        items = [{'key': key, 'file_id': file_id, 'stored_at': stored_at}
+                 for key, (file_id, stored_at) in self._entries.items()]
+        # The bot and the workers may share the file, each one writes its own temporary file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(items, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Unable to save the file_id cache on {self.path}: {e}")
@@ -0,0 +1,107 @@
+import logging
+import os
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects photos above 10 MB or whose width + height is above 10000 px
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TELEGRAM_PHOTO_MAX_DIMENSIONS = 10000
+# Maximum number of photos or documents in a single media group
+TELEGRAM_MEDIA_GROUP_SIZE = 10
+
+# Pillow format name and file extension of the supported output formats
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+    'png': ('PNG', 'png'),
+}
+
+SCREENSHOT_FORMAT = os.getenv('SCREENSHOT_FORMAT', 'jpeg').lower()
+SCREENSHOT_QUALITY = int(os.getenv('SCREENSHOT_QUALITY', '85'))
+SCREENSHOT_MIN_QUALITY = int(os.getenv('SCREENSHOT_MIN_QUALITY', '40'))  # Lowest quality used to meet the size target
+SCREENSHOT_TILE_HEIGHT = int(os.getenv('SCREENSHOT_TILE_HEIGHT', '2000'))
+SCREENSHOT_MAX_TILE_BYTES = int(os.getenv('SCREENSHOT_MAX_TILE_BYTES', str(5 * 1024 * 1024)))
+# Height kept by the tiles of a page too wide for Telegram, the page is cut on the right to make room for it
+MIN_TILE_HEIGHT = 1000
+
+
+def file_extension(fmt):
+    return FORMATS[fmt][1]
+
+
+def tile_size(width, tile_height=SCREENSHOT_TILE_HEIGHT):
+    """Width and height of the tiles of a page `width` pixels wide, within the dimensions Telegram accepts for a photo."""
+    tile_height = max(min(tile_height, TELEGRAM_PHOTO_MAX_DIMENSIONS - width), min(tile_height, MIN_TILE_HEIGHT))
+    return min(width, TELEGRAM_PHOTO_MAX_DIMENSIONS - tile_height), tile_height
+
+
+def encode_image(image, fmt=SCREENSHOT_FORMAT, quality=SCREENSHOT_QUALITY,
+                 max_bytes=SCREENSHOT_MAX_TILE_BYTES, min_quality=SCREENSHOT_MIN_QUALITY):
+    """
+    Encode a PIL image, lowering the quality of lossy formats until it fits in `max_bytes`.
+    The smallest encoding is returned even if it is still above the target.
+    """
+    pil_format = FORMATS[fmt][0]
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    while True:
+        buffer = BytesIO()
+        if pil_format == 'PNG':
+            image.save(buffer, format=pil_format, optimize=True)
+        else:
+            image.save(buffer, format=pil_format, quality=quality)
+        data = buffer.getvalue()
+        if pil_format == 'PNG' or len(data) <= max_bytes or quality <= min_quality:
+            if len(data) > max_bytes:
+                logger.debug(f"Tile of {len(data)} bytes is above the {max_bytes} bytes target")
+            return data
+        quality = max(min_quality, quality - 10)
+
+
+class TileEncoder:
+    """
+    Turns horizontal strips of a page into encoded tiles of a fixed height.
+
+    Only one tile is kept decoded at a time, so memory does not depend on the page height.
+    """
+
+    def __init__(self, width, tile_height=SCREENSHOT_TILE_HEIGHT, fmt=SCREENSHOT_FORMAT, quality=SCREENSHOT_QUALITY,
+                 max_bytes=SCREENSHOT_MAX_TILE_BYTES, min_quality=SCREENSHOT_MIN_QUALITY):
+        # Keep every tile within the dimensions Telegram accepts for a photo, strips wider than the tiles are cut
+        self.width, self.tile_height = tile_size(width, tile_height)
+        self.fmt = fmt
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.min_quality = min_quality
+        self.tiles = []
+        self._canvas = None
+        self._filled = 0
+
+    def add_strip(self, strip):
+        """Append a strip of the page, below the strips added so far."""
+        top = 0
+        while top < strip.height:
+            if self._canvas is None:
+                # Imported here so that modules only needing the constants do not load Pillow
+                from PIL import Image
+                self._canvas = Image.new('RGB', (self.width, self.tile_height), 'white')
+                self._filled = 0
+            rows = min(strip.height - top, self.tile_height - self._filled)
+            self._canvas.paste(strip.crop((0, top, min(strip.width, self.width), top + rows)), (0, self._filled))
+            self._filled += rows
+            top += rows
+            if self._filled == self.tile_height:
+                self._flush()
+
+    def finish(self):
+        """Encode the last, partially filled, tile and return all the encoded tiles."""
+        if self._canvas is not None and self._filled:
+            self._canvas = self._canvas.crop((0, 0, self.width, self._filled))
+            self._flush()
+        return self.tiles
+
+    def _flush(self):
+        self.tiles.append(encode_image(self._canvas, self.fmt, self.quality, self.max_bytes, self.min_quality))
+        self._canvas = None
+        self._filled = 0
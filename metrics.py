@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024  # Latest observations of a series used for its quantiles
+
+
+class Summary:
+    """Count, sum and the latest observations of a timed series."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.window = deque(maxlen=WINDOW)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.window.append(value)
+
+    def quantiles(self):
+        values = sorted(self.window)
+        if not values:
+            return {q: None for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class MetricsRegistry:
+    """
+    Timers, counters and gauges of the process, rendered in the Prometheus text format.
+
+    A series is a metric name plus a set of labels, e.g.
+    observe('scrape_stage_seconds', 1.2, stage='login').
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}  # (name, labels) -> Summary
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # name -> function returning the current value
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary()
+            summary.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block, whether it raises or not."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, read):
+        """Register a function returning the current value of a gauge, read at every scrape of the endpoint."""
+        self._gauges[name] = read
+
+    def quantile(self, name, q, **labels):
+        """(count, value) of a quantile of a series over its latest observations, (0, None) if it was never observed."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None or not summary.window:
+                return 0, None
+            values = sorted(summary.window)
+            return summary.count, values[min(len(values) - 1, int(q * len(values)))]
+
+    def summaries(self):
+        """{(name, labels): (count, sum, quantiles)}, used by /stats."""
+        with self._lock:
+            return {key: (s.count, s.sum, s.quantiles()) for key, s in self._summaries.items()}
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def gauges(self):
+        values = {}
+        for name, read in self._gauges.items():
+            try:
+                values[name] = read()
+            except Exception as e:
+                logger.debug(f"Unable to read the gauge {name}: {e}")
+        return values
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (count, total, quantiles) in sorted(self.summaries().items()):
+            header(name, 'summary')
+            for q, value in quantiles.items():
+                if value is not None:
+                    lines.append(f"{name}{_labels(labels + (('quantile', q),))} {value:.6f}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in sorted(self.counters().items()):
+            header(name, 'counter')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for name, value in sorted(self.gauges().items()):
+            header(name, 'gauge')
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+# Registry shared by the whole process
+registry = MetricsRegistry()
+observe = registry.observe
+timer = registry.timer
+increment = registry.increment
+
+registry.describe('scrape_stage_seconds', "Seconds spent in each stage of a scrape")
+registry.describe('scrape_seconds', "Seconds of a whole scrape, from borrowing the browser to the result")
+registry.describe('scrapes_total', "Scrapes by outcome")
+registry.describe('telegram_send_seconds', "Seconds of a request to the Telegram API, waiting for the rate limits included")
+registry.describe('telegram_sends_total', "Requests to the Telegram API by outcome")
+registry.describe('flow_step_seconds', "Seconds taken by each successful step of a scrape flow")
+registry.describe('flow_resumes_total', "Scrape flows resumed from a checkpoint after a failing step")
+registry.describe('circuit_opened_total', "Times the circuit breaker stopped the scrapes of a failing site")
+registry.describe('batch_seconds', "Seconds of a /screenshot_batch run, all its tabs included")
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Serve the registry on http://host:port/metrics from a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"Metrics endpoint: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriptions:
+    """Chats subscribed to the updates of a (ship, port) combination, persisted as JSON."""
+
+    def __init__(self, path="data/subscriptions.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chats = {}
+        try:
+            with open(self.path) as f:
+                for item in json.load(f):
+                    self._chats[(item['ship_name'], item['port_of_departure'])] = set(item['chats'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def subscribe(self, key, chat_id):
+        with self._lock:
+            self._chats.setdefault(key, set()).add(chat_id)
+            self._save()
+
+    def unsubscribe(self, key, chat_id):
+        """Returns False if the chat was not subscribed."""
+        with self._lock:
+            chats = self._chats.get(key, set())
+            if chat_id not in chats:
+                return False
+            chats.discard(chat_id)
+            if not chats:
+                del self._chats[key]
+            self._save()
+            return True
+
+    def chats_for(self, key):
+        with self._lock:
+            return set(self._chats.get(key, ()))
+
+    def keys_for(self, chat_id):
+        with self._lock:
+            return [key for key, chats in self._chats.items() if chat_id in chats]
+
+    def _save(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        items = [
+            {'ship_name': key[0], 'port_of_departure': key[1], 'chats': sorted(chats)}
+            for key, chats in self._chats.items()
+        ]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(items, f)
+        os.replace(tmp_path, self.path)
+
+
+class PrecomputeScheduler:
+    """
+    Refreshes every (ship, port) combination in the background.
+
+    Each combination has its own interval, shorter the more it is requested or
+    subscribed to, with some jitter so that refreshes do not line up. When several
+    combinations are due the most requested one goes first.
+    """
+
+    def __init__(self, combinations, refresh, on_result=None, subscriptions=None, base_interval=600,
+                 min_interval=120, idle_factor=3, jitter=0.1, demand_half_life=3600, max_concurrent=1):
+        self.combinations = list(combinations)
+        self.refresh = refresh  # Coroutine function called with (ship, port), returning a ScrapeResult or None
+        self.on_result = on_result  # Coroutine function called with each refreshed ScrapeResult
+        self.subscriptions = subscriptions
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.idle_factor = idle_factor  # Combinations nobody asks for are refreshed this many times less often
+        self.jitter = jitter
+        self.demand_half_life = demand_half_life
+        self.max_concurrent = max_concurrent
+        self._demand = {}
+        self._demand_time = {}
+        self._last_run = {}
+        self._next_run = {}
+        self._running = set()
+        self._refreshes = set()  # The event loop only keeps weak references to the refresh tasks
+        self._task = None
+        self._wakeup = None
+        self._slots = None
+
+    def start(self):
+        """Start refreshing, must be called from the running event loop."""
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        now = time.monotonic()
+        # Spread the first refreshes instead of scraping everything at boot
+        for key in self.combinations:
+            self._next_run[key] = now + random.uniform(0, self.min_interval)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Stop the loop and the refreshes still running."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        refreshes = list(self._refreshes)
+        for task in refreshes:
+            task.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+
+    def record_demand(self, key):
+        """Called on every interactive request, makes the combination refresh more often."""
+        now = time.monotonic()
+        self._demand[key] = self.demand(key, now) + 1
+        self._demand_time[key] = now
+        if key in self._next_run and key in self._last_run:
+            self._next_run[key] = min(self._next_run[key], self._last_run[key] + self.interval(key))
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def demand(self, key, now=None):
+        """Exponentially decaying count of the requests for the combination."""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._demand_time.get(key, now)
+        return self._demand.get(key, 0) * 0.5 ** (elapsed / self.demand_half_life)
+
+    def interval(self, key):
+        demand = self.demand(key)
+        if self.subscriptions is not None:
+            demand += len(self.subscriptions.chats_for(key))
+        if demand < 0.1:
+            return self.base_interval * self.idle_factor
+        return max(self.min_interval, self.base_interval / (1 + demand))
+
+    async def _loop(self):
+        while True:
+            now = time.monotonic()
+            due = [key for key, at in self._next_run.items() if at <= now and key not in self._running]
+            if due:
+                key = max(due, key=self.demand)
+                await self._slots.acquire()
+                self._running.add(key)
+                task = asyncio.create_task(self._refresh(key))
+                self._refreshes.add(task)
+                task.add_done_callback(self._refreshes.discard)
+                continue
+
+            waiting = [at for key, at in self._next_run.items() if key not in self._running]
+            delay = min(waiting) - now if waiting else self.min_interval
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refresh(self, key):
+        started = time.monotonic()
+        try:
+            result = await self.refresh(*key)
+            if self.on_result is not None and result is not None:
+                await self.on_result(result)
+        except Exception as e:
+            logger.error(f"Background refresh of {key} failed: {e}")
+        finally:
+            self._last_run[key] = started
+            interval = self.interval(key)
+            self._next_run[key] = started + interval * (1 + random.uniform(-self.jitter, self.jitter))
+            self._running.discard(key)
+            self._slots.release()
+            self._wakeup.set()
+            logger.debug(f"Next background refresh of {key} in {self._next_run[key] - time.monotonic():.0f}s")
@@ -0,0 +1,98 @@
+import logging
+from collections import Counter
+
+from cdp import execute_cdp
+
+logger = logging.getLogger(__name__)
+
+TRACKER_PATTERNS = [
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*facebook.net*",
+    "*connect.facebook.com*",
+    "*hotjar.com*",
+    "*clarity.ms*",
+    "*criteo.com*",
+    "*taboola.com*",
+    "*outbrain.com*",
+    "*adservice.google.*",
+    "*scorecardresearch.com*",
+    "*newrelic.com*",
+    "*nr-data.net*",
+    "*optimizely.com*",
+]
+
+MEDIA_PATTERNS = [
+    "*.mp4*", "*.webm*", "*.m3u8*", "*.mp3*", "*.ogg*",
+    "*.woff*", "*.woff2*", "*.ttf*", "*.otf*", "*.eot*",
+]
+
+IMAGE_PATTERNS = ["*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*"]
+
+STYLE_PATTERNS = ["*.css*"]
+
+# URL patterns blocked by each profile, selected per flow
+PROFILES = {
+    'none': [],
+    'block_trackers': TRACKER_PATTERNS,
+    # Video, audio and web fonts are never part of the results; images are kept because the result cards show them
+    'block_media_except_results': TRACKER_PATTERNS + MEDIA_PATTERNS,
+    # For flows which only read the text of the results and take no screenshot
+    'text_only': TRACKER_PATTERNS + MEDIA_PATTERNS + IMAGE_PATTERNS + STYLE_PATTERNS,
+}
+
+# Rough size of a resource which was never downloaded, used to estimate the bytes saved by blocking it
+ESTIMATED_RESOURCE_BYTES = {
+    'Image': 40 * 1024,
+    'Media': 500 * 1024,
+    'Font': 40 * 1024,
+    'Script': 60 * 1024,
+    'Stylesheet': 30 * 1024,
+}
+DEFAULT_ESTIMATED_RESOURCE_BYTES = 20 * 1024
+
+
+def check_profile(name):
+    """Raise ValueError for a name which is not one of PROFILES, e.g. a mistyped setting."""
+    if name not in PROFILES:
+        raise ValueError(f"Unknown request profile: {name}. Valid profiles are: {', '.join(PROFILES)}")
+
+
+def apply_profile(driver, name):
+    """Block the URLs of the profile for the next navigations of the browser."""
+    check_profile(name)
+    execute_cdp(driver, "Network.enable")
+    execute_cdp(driver, "Network.setBlockedURLs", {"urls": PROFILES[name]})
+    logger.debug(f"Request profile {name} applied ({len(PROFILES[name])} blocked patterns)")
+
+
+def network_stats(events):
+    """
+    Summarise the Network events of a run: requests made, bytes downloaded and
+    requests blocked by the profile, with an estimate of the bytes they would have cost.
+    """
+    resource_types = {}
+    downloaded = 0
+    requests = 0
+    blocked = Counter()
+    for event in events:
+        method = event.get('method')
+        params = event.get('params', {})
+        if method == 'Network.requestWillBeSent':
+            requests += 1
+            resource_types[params.get('requestId')] = params.get('type', 'Other')
+        elif method == 'Network.loadingFinished':
+            downloaded += int(params.get('encodedDataLength', 0))
+        elif method == 'Network.loadingFailed' and params.get('blockedReason'):
+            blocked[params.get('type') or resource_types.get(params.get('requestId'), 'Other')] += 1
+
+    saved = sum(ESTIMATED_RESOURCE_BYTES.get(t, DEFAULT_ESTIMATED_RESOURCE_BYTES) * n for t, n in blocked.items())
+    return {
+        'requests': requests,
+        'bytes_downloaded': downloaded,
+        'requests_blocked': sum(blocked.values()),
+        'blocked_by_type': dict(blocked),
+        'estimated_bytes_saved': saved,
+    }
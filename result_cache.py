@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+from scrape_result import ScrapeResult, CruiseResult
+
+logger = logging.getLogger(__name__)
+
+TEXT_ONLY = 'text'  # Last part of the key of text only results, so that they never replace a screenshot
+
+
+class ResultCache:
+    """
+    Two tier (memory and disk) cache of ScrapeResult keyed by (ship, port), text only
+    results are kept apart under (ship, port, TEXT_ONLY).
+
+    Entries older than `ttl` seconds are not served. Both tiers are bounded and
+    evict the least recently used entries first. The disk tier is written on a
+    background thread, so storing a result never waits for the disk. A memory miss
+    reads the disk, so the event loop calls get() and latest() through asyncio.to_thread.
+    """
+
+    def __init__(self, ttl=600, max_entries=32, disk_dir="cache/results", max_disk_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir  # None disables the disk tier
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # A single writer keeps the writes and removals of an entry in order
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='result-cache') if disk_dir else None
+
+    def get(self, ship_name, port_of_departure, with_images=True):
+        """
+        Return the fresh result for the combination, or None.
+        With `with_images` False the result of a text only search may be returned too, the newest one wins.
+        """
+        result = self._get((ship_name, port_of_departure))
+        if with_images:
+            # Entries written before text only results got their own key may have no images
+            return result if result is not None and result.images else None
+        return _newest(result, self._get((ship_name, port_of_departure, TEXT_ONLY)))
+
+    def _get(self, key):
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                if self._is_fresh(result):
+                    self._memory.move_to_end(key)
+                    return result
+                del self._memory[key]
+
+        result = self._read_disk(key)
+        if result is None:
+            return None
+        if not self._is_fresh(result):
+            self._submit(self._remove_disk, key)
+            return None
+        # Promote to the memory tier so that the next hit does not touch the disk
+        self._put_memory(result)
+        return result
+
+    def latest(self, ship_name, port_of_departure, with_images=True):
+        """
+        Return the last result of the combination even if it is not fresh anymore, used for change detection.
+        `with_images` works as in get().
+        """
+        result = self._latest((ship_name, port_of_departure))
+        if with_images:
+            return result
+        return _newest(result, self._latest((ship_name, port_of_departure, TEXT_ONLY)))
+
+    def _latest(self, key):
+        with self._lock:
+            result = self._memory.get(key)
+        if result is None:
+            result = self._read_disk(key)
+        return result
+
+    def put(self, result):
+        """Store the result in memory straight away, its copy on disk is written in the background."""
+        self._put_memory(result)
+        self._submit(self._write_disk, result)
+
+    def invalidate(self, ship_name, port_of_departure):
+        for key in ((ship_name, port_of_departure), (ship_name, port_of_departure, TEXT_ONLY)):
+            with self._lock:
+                self._memory.pop(key, None)
+            self._submit(self._remove_disk, key)
+
+    def close(self):
+        """Wait for the pending disk writes."""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+
+    def _key(self, result):
+        return result.key if result.images else result.key + (TEXT_ONLY,)
+
+    def _submit(self, fn, *args):
+        if self._writer is not None:
+            self._writer.submit(fn, *args)
+
+    def _is_fresh(self, result):
+        return self.ttl is None or result.age() < self.ttl
+
+    def _put_memory(self, result):
+        key = self._key(result)
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _entry_dir(self, key):
+        digest = hashlib.sha1("\0".join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, digest)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json")) as f:
+                meta = json.load(f)
+            images = []
+            for name in meta['images']:
+                with open(os.path.join(entry_dir, name), 'rb') as f:
+                    images.append(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        # Mark the entry as recently used for the eviction of the disk tier
+        os.utime(entry_dir)
+        records = [CruiseResult(**record) for record in meta.get('records', [])]
+        return ScrapeResult(meta['ship_name'], meta['port_of_departure'], images, meta.get('text'), meta['created_at'],
+                            meta.get('image_format', 'png'), records=records,
+                            content_hash=meta.get('content_hash'), image_hash=meta.get('image_hash'))
+
+    def _write_disk(self, result):
+        if not self.disk_dir:
+            return
+        entry_dir = self._entry_dir(self._key(result))
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            names = []
+            for i, image in enumerate(result.images):
+                name = f"image_{i}.bin"
+                path = os.path.join(entry_dir, name)
+                # An unchanged result reuses the images of the previous one, which are already on disk
+                if result.changed or not os.path.exists(path):
+                    with open(path, 'wb') as f:
+                        f.write(image)
+                names.append(name)
+            meta = {
+                'ship_name': result.ship_name,
+                'port_of_departure': result.port_of_departure,
+                'text': result.text,
+                'created_at': result.created_at,
+                'image_format': result.image_format,
+                'records': [asdict(record) for record in result.records],
+                'content_hash': result.content_hash,
+                'image_hash': result.image_hash,
+                'images': names,
+            }
+            # The metadata is written last so that a reader never sees missing images
+            tmp_path = os.path.join(entry_dir, "meta.json.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, os.path.join(entry_dir, "meta.json"))
+            self._evict_disk()
+        except OSError as e:
+            logger.error(f"Unable to write the cache entry on disk: {e}")
+
+    def _remove_disk(self, key):
+        if self.disk_dir:
+            self._remove_entry_dir(self._entry_dir(key))
+
+    def _remove_entry_dir(self, entry_dir):
+        try:
+            for name in os.listdir(entry_dir):
+                os.remove(os.path.join(entry_dir, name))
+            os.rmdir(entry_dir)
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        entries = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir)]
+        entries = [e for e in entries if os.path.isdir(e)]
+        if len(entries) <= self.max_disk_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry_dir in entries[:len(entries) - self.max_disk_entries]:
+            self._remove_entry_dir(entry_dir)
+
+
+def _newest(*results):
+    results = [result for result in results if result is not None]
+    return max(results, key=lambda result: result.created_at) if results else None
@@ -0,0 +1,153 @@
+import html
+import logging
+import math
+
+from telegram import InputMediaPhoto, InputMediaDocument
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import ExtBot
+
+from file_id_cache import FileIdCache
+from image_tiles import file_extension, TELEGRAM_MEDIA_GROUP_SIZE, TELEGRAM_PHOTO_MAX_BYTES
+from results_extractor import format_cruise_results
+from send_dispatcher import INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+# Telegram messages are limited to 4096 characters, some room is left for the "..." marking a cut
+TELEGRAM_MESSAGE_MAX_LENGTH = 4000
+
+
+async def send_result(telegram_bot: ExtBot, chat_id, result, priority=INTERACTIVE, file_ids: FileIdCache = None) -> None:
+    """
+    Send the images of a ScrapeResult to the chat, as an album when the page was split in tiles.
+    `priority` is handed to the SendDispatcher of the bot. Images found in `file_ids` are sent
+    by reference instead of being uploaded again.
+    """
+    await _send_images(telegram_bot, chat_id, result.images, file_extension(result.image_format), None, priority, file_ids)
+
+
+async def send_batch_results(telegram_bot: ExtBot, chat_id, results, priority=INTERACTIVE, file_ids: FileIdCache = None) -> None:
+    """
+    Send the images of several ScrapeResults as a single album, the first image of each
+    captioned with its ship and port. Too many or too big images are sent like in send_result.
+    """
+    images = []
+    captions = []
+    for result in results:
+        if not result.images:
+            continue
+        images.extend(result.images)
+        captions.extend([f"{result.ship_name} - {result.port_of_departure}"] + [None] * (len(result.images) - 1))
+    if images:
+        await _send_images(telegram_bot, chat_id, images, file_extension(results[0].image_format), captions, priority,
+                           file_ids)
+
+
+async def _send_images(telegram_bot: ExtBot, chat_id, images, extension, captions, priority, file_ids):
+    rate_limit_args = {'priority': priority}
+    captions = captions or [None] * len(images)
+    # Captures which do not fit in a single album, or have tiles too big for a photo, are sent as files
+    as_documents = len(images) > TELEGRAM_MEDIA_GROUP_SIZE or any(len(image) > TELEGRAM_PHOTO_MAX_BYTES for image in images)
+    kind = 'document' if as_documents else 'photo'
+
+    for start in range(0, len(images), TELEGRAM_MEDIA_GROUP_SIZE):
+        chunk = images[start:start + TELEGRAM_MEDIA_GROUP_SIZE]
+        chunk_captions = captions[start:start + TELEGRAM_MEDIA_GROUP_SIZE]
+        if len(images) == 1:
+            filenames = [f"screenshot.{extension}"]
+        else:
+            filenames = [f"screenshot_{start + i + 1}.{extension}" for i in range(len(chunk))]
+        sources = [(file_ids.get(image, kind) if file_ids is not None else None) or image for image in chunk]
+        try:
+            messages = await _send_chunk(telegram_bot, chat_id, sources, filenames, chunk_captions, as_documents, rate_limit_args)
+        except BadRequest as e:
+            reused = [source for source in sources if isinstance(source, str)]
+            if not reused or not _is_file_id_error(e):
+                raise
+            logger.warning(f"Telegram refused a cached file_id ({e}), uploading the images again")
+            for file_id in reused:
+                file_ids.invalidate(file_id)
+            sources = chunk
+            messages = await _send_chunk(telegram_bot, chat_id, sources, filenames, chunk_captions, as_documents, rate_limit_args)
+
+        if file_ids is not None:
+            for image, source, message in zip(chunk, sources, messages):
+                if isinstance(source, bytes):
+                    file_id = message.document.file_id if as_documents else message.photo[-1].file_id
+                    file_ids.put(image, kind, file_id)
+
+
+async def _send_chunk(telegram_bot: ExtBot, chat_id, sources, filenames, captions, as_documents, rate_limit_args):
+    """Send up to one album of images or file_ids and return the messages, in the same order."""
+    if len(sources) == 1:
+        # A media group needs at least two items
+        if as_documents:
+            message = await telegram_bot.send_document(chat_id=chat_id, document=sources[0], filename=filenames[0],
+                                                       caption=captions[0], rate_limit_args=rate_limit_args)
+        else:
+            message = await telegram_bot.send_photo(chat_id=chat_id, photo=sources[0], caption=captions[0],
+                                                    rate_limit_args=rate_limit_args)
+        return [message]
+    if as_documents:
+        media = [InputMediaDocument(source, filename=filename, caption=caption)
+                 for source, filename, caption in zip(sources, filenames, captions)]
+    else:
+        media = [InputMediaPhoto(source, caption=caption) for source, caption in zip(sources, captions)]
+    return list(await telegram_bot.send_media_group(chat_id=chat_id, media=media, rate_limit_args=rate_limit_args))
+
+
+def _is_file_id_error(error):
+    message = str(error).lower()
+    return 'file identifier' in message or 'file_id' in message or 'file reference' in message
+
+
+async def send_cruise_results(telegram_bot: ExtBot, chat_id, result, priority=INTERACTIVE) -> None:
+    """
+    Send the cruises of a ScrapeResult to the chat as text
+    """
+    if result.records:
+        text = format_cruise_results(result.ship_name, result.port_of_departure, result.records)
+    elif result.text:
+        # The raw text of the whole results container, which can be far longer than a message
+        text = _escape_truncated(result.text)
+    else:
+        text = f"No cruises found for {result.ship_name} from {result.port_of_departure}."
+    await telegram_bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                                    rate_limit_args={'priority': priority})
+
+
+def _escape_truncated(text, limit=TELEGRAM_MESSAGE_MAX_LENGTH):
+    """HTML escape the text, cut on a line boundary when it does not fit in a message."""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    cut = escaped.rfind("\n", 0, limit)
+    if cut > 0:
+        return escaped[:cut] + "\n..."
+    # A single long line: cut the raw text, so that no escaped character is split
+    end = limit
+    while len(html.escape(text[:end])) > limit:
+        end -= max(1, (len(html.escape(text[:end])) - limit) // 5)  # An escaped character is at most 6 long
+    return html.escape(text[:end]) + "..."
+
+
+async def send_degraded(telegram_bot: ExtBot, chat_id, ship_name, port_of_departure, latest, retry_after, capture=True,
+                        priority=INTERACTIVE, file_ids: FileIdCache = None) -> None:
+    """
+    Answer while the site is down: the last result of the combination, however old, or a short notice
+    """
+    rate_limit_args = {'priority': priority}
+    usable = latest is not None and (latest.images if capture else (latest.records or latest.text))
+    if not usable:
+        minutes = max(1, math.ceil(retry_after / 60))
+        await telegram_bot.send_message(chat_id=chat_id, rate_limit_args=rate_limit_args,
+                                        text=f"The cruise site is not responding at the moment. Please try again in {minutes} minutes.")
+        return
+    await telegram_bot.send_message(chat_id=chat_id, rate_limit_args=rate_limit_args,
+                                    text=f"The cruise site is not responding at the moment, this is the last result for "
+                                         f"{ship_name} from {port_of_departure}, {latest.age() / 60:.0f} minutes old.")
+    if capture:
+        await send_result(telegram_bot, chat_id, latest, priority=priority, file_ids=file_ids)
+    else:
+        await send_cruise_results(telegram_bot, chat_id, latest, priority=priority)
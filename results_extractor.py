@@ -0,0 +1,120 @@
+import base64
+import html
+import json
+import logging
+import os
+import re
+
+from cdp import execute_cdp
+from scrape_result import CruiseResult
+
+logger = logging.getLogger(__name__)
+
+# Only the XHR/fetch responses whose URL matches are parsed for cruises
+RESULTS_URL_PATTERN = re.compile(os.getenv('RESULTS_URL_PATTERN', r'search|cruise|result'), re.IGNORECASE)
+
+# Keys under which the target site may return each field, the first one found wins
+FIELD_ALIASES = {
+    'ship': ('ship', 'shipName', 'ship_name', 'vessel', 'vesselName'),
+    'port': ('port', 'portOfDeparture', 'departurePort', 'embarkationPort', 'port_of_departure'),
+    'departure_date': ('departureDate', 'departure_date', 'sailDate', 'startDate', 'embarkationDate'),
+    'return_date': ('returnDate', 'return_date', 'endDate', 'disembarkationDate', 'arrivalDate'),
+    'price': ('price', 'fromPrice', 'totalPrice', 'amount', 'priceFrom', 'bestPrice'),
+    'currency': ('currency', 'currencyCode'),
+}
+
+
+def collect_json_responses(driver, events):
+    """Fetch the body of every JSON XHR/fetch response of the run whose URL matches RESULTS_URL_PATTERN."""
+    payloads = []
+    for event in events:
+        if event.get('method') != 'Network.responseReceived':
+            continue
+        params = event.get('params', {})
+        response = params.get('response', {})
+        if params.get('type') not in ('XHR', 'Fetch') or 'json' not in response.get('mimeType', ''):
+            continue
+        if not RESULTS_URL_PATTERN.search(response.get('url', '')):
+            continue
+        try:
+            body = execute_cdp(driver, "Network.getResponseBody", {"requestId": params['requestId']})
+            data = body['body']
+            if body.get('base64Encoded'):
+                data = base64.b64decode(data).decode('utf-8')
+            payloads.append(json.loads(data))
+        except Exception as e:
+            # The body is gone once the browser navigates away or evicts it from its buffer
+            logger.debug(f"Unable to read the response of {response.get('url')}: {e}")
+    return payloads
+
+
+def parse_cruise_results(payloads, ship_name=None, port_of_departure=None):
+    """Walk the JSON payloads and turn every object with a price and a departure date into a CruiseResult."""
+    records = []
+    for payload in payloads:
+        for item in _walk(payload):
+            price = _first(item, 'price')
+            departure_date = _first(item, 'departure_date')
+            if price is None or departure_date is None:
+                continue
+            currency = _first(item, 'currency')
+            if isinstance(price, dict):
+                currency = currency or _first(price, 'currency')
+                price = _first(price, 'price') or price.get('value')
+            try:
+                price = float(price)
+            except (TypeError, ValueError):
+                continue
+            records.append(CruiseResult(
+                ship=_name(_first(item, 'ship')) or ship_name,
+                port=_name(_first(item, 'port')) or port_of_departure,
+                departure_date=str(departure_date),
+                return_date=_first(item, 'return_date'),
+                price=price,
+                currency=currency,
+            ))
+    records.sort(key=lambda r: (r.departure_date or '', r.price))
+    return records
+
+
+def extract_cruise_results(driver, events, ship_name=None, port_of_departure=None):
+    records = parse_cruise_results(collect_json_responses(driver, events), ship_name, port_of_departure)
+    logger.debug(f"{len(records)} cruises read from the network responses")
+    return records
+
+
+def format_cruise_results(ship_name, port_of_departure, records, limit=30):
+    """Build the HTML text reply for /results, escaping what the user and the site sent."""
+    lines = [f"<b>Cruises of {html.escape(str(ship_name))} from {html.escape(str(port_of_departure))}</b>", ""]
+    for record in records[:limit]:
+        departure_date = html.escape(str(record.departure_date))
+        dates = departure_date if not record.return_date else f"{departure_date} → {html.escape(str(record.return_date))}"
+        price = f"{record.price:.2f} {html.escape(str(record.currency))}" if record.currency else f"{record.price:.2f}"
+        lines.append(f"• {dates}: <b>{price}</b>")
+    if len(records) > limit:
+        lines.append(f"\n... and {len(records) - limit} more")
+    return "\n".join(lines)
+
+
+def _walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+def _first(item, field_name):
+    for key in FIELD_ALIASES[field_name]:
+        if item.get(key) is not None:
+            return item[key]
+    return None
+
+
+def _name(value):
+    # Ships and ports are sometimes objects like {"name": "Genoa", "code": "GOA"}
+    if isinstance(value, dict):
+        return value.get('name')
+    return value
@@ -0,0 +1,163 @@
+import asyncio
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapeCancelled(Exception):
+    """Raised when a scrape job is cancelled before it completes."""
+
+
+class QueueFull(Exception):
+    """Raised when too many scrape jobs are waiting."""
+
+
+class ScrapeJob:
+    """A blocking scrape waiting in, or running on, the ScrapeExecutor."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, func, key=None, owner=None):
+        self.id = next(self._ids)
+        self.func = func
+        self.key = key
+        self.owners = {owner} if owner is not None else set()  # Chats waiting for the result
+        self.cancelled_owners = set()  # Chats which stopped waiting with cancel_for_owner()
+        self.state = 'queued'
+        self.cancel_event = threading.Event()  # Checked by the scrape between steps
+        self.future = asyncio.get_running_loop().create_future()
+
+    def add_owner(self, owner):
+        """Wait for the result on behalf of `owner` too, even if it cancelled this job before."""
+        self.owners.add(owner)
+        self.cancelled_owners.discard(owner)
+
+    def cancelled_by(self, owner):
+        """True if `owner` stopped waiting for the job, a chat which never joined it did not."""
+        return owner in self.cancelled_owners
+
+
+class ScrapeExecutor:
+    """
+    Runs blocking Selenium work on a bounded pool of threads, so that the event
+    loop of the bot keeps serving updates while browsers are busy.
+
+    Jobs are started in FIFO order and at most `max_workers` run at the same time.
+    """
+
+    def __init__(self, max_workers=2, max_queue=50):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._running = {}
+        self._pool = None
+        self._workers = []
+        self._wakeup = None
+
+    def start(self):
+        """Start the workers, must be called from the running event loop."""
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scrape')
+        self._wakeup = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def shutdown(self):
+        for job in list(self._queue):
+            self._cancel(job)
+        for job in list(self._running.values()):
+            job.cancel_event.set()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def submit(self, func, key=None, owner=None):
+        """
+        Queue `func(cancel_event)` and return its ScrapeJob; await `job.future` for the result.
+        """
+        if len(self._queue) >= self.max_queue:
+            raise QueueFull(f"{len(self._queue)} scrape jobs are already waiting")
+        job = ScrapeJob(func, key, owner)
+        self._queue.append(job)
+        asyncio.ensure_future(self._notify())
+        return job
+
+    def find(self, key):
+        """Return the queued or running job for `key`, if any."""
+        for job in itertools.chain(self._running.values(), self._queue):
+            if job.key == key:
+                return job
+        return None
+
+    def position(self, job):
+        """0 if the job is running, otherwise its 1 based position in the queue."""
+        if job.state == 'running':
+            return 0
+        try:
+            index = self._queue.index(job)
+        except ValueError:
+            return 0
+        # Jobs which are about to be picked up by an idle worker are not really waiting
+        idle_workers = self.max_workers - len(self._running)
+        return max(0, index + 1 - idle_workers)
+
+    def queue_length(self):
+        return len(self._queue)
+
+    def running_count(self):
+        return len(self._running)
+
+    def cancel_for_owner(self, owner):
+        """
+        Stop waiting on behalf of `owner`. Jobs left without owners are cancelled.
+        Returns the number of jobs the owner was waiting for.
+        """
+        count = 0
+        for job in list(itertools.chain(self._running.values(), self._queue)):
+            if owner in job.owners:
+                count += 1
+                job.owners.discard(owner)
+                job.cancelled_owners.add(owner)
+                if not job.owners:
+                    self._cancel(job)
+        return count
+
+    def _cancel(self, job):
+        if job.state == 'queued':
+            self._queue.remove(job)
+            job.state = 'cancelled'
+            if not job.future.done():
+                job.future.set_exception(ScrapeCancelled(f"Scrape job {job.id} cancelled"))
+        elif job.state == 'running':
+            # A running thread cannot be killed, the scrape stops at its next checkpoint
+            job.cancel_event.set()
+
+    async def _notify(self):
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: self._queue)
+                job = self._queue.popleft()
+            job.state = 'running'
+            self._running[job.id] = job
+            logger.debug(f"Scrape job {job.id} started, {len(self._queue)} waiting")
+            try:
+                result = await loop.run_in_executor(self._pool, job.func, job.cancel_event)
+                if not job.future.done():
+                    job.future.set_result(result)
+                job.state = 'done'
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                job.state = 'cancelled' if isinstance(e, ScrapeCancelled) else 'failed'
+            finally:
+                del self._running[job.id]
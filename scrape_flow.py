@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from string import Template
+from typing import Optional
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+from scrape_executor import ScrapeCancelled
+from metrics import registry, observe, increment
+
+logger = logging.getLogger(__name__)
+
+# Flows followed by the scraper, see flows/cruise_site.json
+FLOW_FILE = os.getenv('FLOW_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows', 'cruise_site.json'))
+FLOW_STEP_TIMEOUT = float(os.getenv('FLOW_STEP_TIMEOUT', '10'))  # Seconds an element is waited for when the step sets no timeout
+FLOW_MAX_RESUMES = int(os.getenv('FLOW_MAX_RESUMES', '2'))  # Resumes from a checkpoint before a flow gives up
+
+# Steps wait ADAPTIVE_TIMEOUT_FACTOR times the p99 of their latest successful runs, never more than
+# their configured timeout, so that a slow or dead site frees the browser early
+ADAPTIVE_TIMEOUTS = os.getenv('ADAPTIVE_TIMEOUTS', 'true').lower() == 'true'
+ADAPTIVE_TIMEOUT_FACTOR = float(os.getenv('ADAPTIVE_TIMEOUT_FACTOR', '3'))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv('ADAPTIVE_TIMEOUT_MIN', '2'))  # Seconds a step may always wait
+ADAPTIVE_TIMEOUT_SAMPLES = int(os.getenv('ADAPTIVE_TIMEOUT_SAMPLES', '20'))  # Runs of a step before its timeout adapts
+
+LOCATORS = {
+    'xpath': By.XPATH,
+    'id': By.ID,
+    'css': By.CSS_SELECTOR,
+}
+
+
+@dataclass
+class FlowStep:
+    """A single action of a flow, selectors and values can use ${name} placeholders."""
+    name: str
+    action: str  # 'get', 'click', 'type', 'wait' or an action given to ScrapeFlow.run
+    by: str = 'xpath'  # Key of LOCATORS
+    selector: Optional[str] = None
+    url: Optional[str] = None  # Page opened by 'get'
+    value: Optional[str] = None  # Text typed by 'type', replacing what the input holds
+    submit: bool = False  # Press Enter after typing
+    timeout: Optional[float] = None  # Seconds the step may wait, the action default when missing
+    checkpoint: bool = False  # A later failure resumes the flow after this step
+
+
+class Checkpoint:
+    """Where a flow resumes: the index of the next step and the page it was on."""
+
+    def __init__(self, step, url, reload=False):
+        self.step = step
+        self.url = url
+        self.reload = reload  # Reload the page even if the browser is still on it
+        self.resumed = False
+
+
+class ScrapeFlow:
+    """
+    Steps run in order on a browser. A failing step does not abort the flow: the browser goes back
+    to the page of the latest checkpoint and the flow resumes from there, up to `max_resumes` times.
+    The start of the flow is a checkpoint too, so a flow without checkpoints is restarted from its first step.
+    """
+
+    def __init__(self, name, steps, max_resumes=FLOW_MAX_RESUMES):
+        self.name = name
+        self.steps = steps
+        self.max_resumes = max_resumes
+
+    @classmethod
+    def from_dict(cls, name, data):
+        steps = [FlowStep(**step) for step in data['steps']]
+        for step in steps:
+            if step.by not in LOCATORS:
+                raise ValueError(f"Unknown locator '{step.by}' in step {step.name} of the {name} flow")
+        return cls(name, steps, data.get('max_resumes', FLOW_MAX_RESUMES))
+
+    def run(self, driver, params, cancel_event=None, actions=None, default_timeouts=None):
+        """
+        Run the flow with `params` filled in the ${name} placeholders of the steps.
+        `actions` maps extra action names to functions called with (driver, step, timeout),
+        `default_timeouts` the timeout of the steps of an action which set none.
+        Returns the seconds taken by each step.
+        """
+        flow_run = self.start(driver, params, actions, default_timeouts)
+        while not flow_run.done:
+            if cancel_event is not None and cancel_event.is_set():
+                raise ScrapeCancelled("Scrape cancelled")
+            flow_run.advance()
+        logger.debug(f"{self.name} flow done in {sum(flow_run.timings.values()):.2f}s: "
+                     + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in flow_run.timings.items()))
+        return flow_run.timings
+
+    def start(self, driver, params, actions=None, default_timeouts=None):
+        """A FlowRun on the page the browser is on, advanced step by step by the caller."""
+        return FlowRun(self, driver, params, actions or {}, default_timeouts or {})
+
+    def timeout(self, step, default):
+        """Seconds the step may wait: its configured timeout, shortened to what the step usually takes."""
+        limit = step.timeout if step.timeout is not None else default
+        if not ADAPTIVE_TIMEOUTS:
+            return limit
+        count, p99 = registry.quantile('flow_step_seconds', 0.99, flow=self.name, step=step.name)
+        if count < ADAPTIVE_TIMEOUT_SAMPLES:
+            return limit
+        return min(limit, max(ADAPTIVE_TIMEOUT_MIN, p99 * ADAPTIVE_TIMEOUT_FACTOR))
+
+    def run_step(self, driver, step, params, actions, timeout):
+        if step.action in actions:
+            actions[step.action](driver, step, timeout)
+        elif step.action == 'get':
+            driver.get(fill(step.url, params))
+        elif step.action == 'wait':
+            self.find(driver, step, params, timeout)
+        elif step.action == 'click':
+            self.find(driver, step, params, timeout).click()
+        elif step.action == 'type':
+            element = self.find(driver, step, params, timeout)
+            # A flow resumed on the same page finds the text typed before its failure still there
+            element.clear()
+            element.send_keys(fill(step.value, params))
+            if step.submit:
+                element.send_keys(Keys.RETURN)
+        else:
+            raise ValueError(f"Unknown action '{step.action}' in step {step.name} of the {self.name} flow")
+
+    def find(self, driver, step, params, timeout):
+        """Wait for the element of the step to be in the page and return it."""
+        locator = (LOCATORS[step.by], fill(step.selector, params))
+        return WebDriverWait(driver, timeout).until(EC.presence_of_element_located(locator))
+
+
+def fill(text, params):
+    """Replace the ${name} placeholders of a step, missing parameters are left as they are."""
+    if text is None:
+        return None
+    return Template(text).safe_substitute({key: '' if value is None else value for key, value in params.items()})
+
+
+def load_flows(path=FLOW_FILE):
+    """Read the flows of a JSON file, {name: {"steps": [...]}}, as {name: ScrapeFlow}."""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return {name: ScrapeFlow.from_dict(name, flow) for name, flow in data.items()}
+
+
+class FlowRun:
+    """
+    Progress of a flow on one browser tab. Calling advance() on the runs of several tabs in turn
+    lets their pages load at the same time, the driver switching to the tab of the run first.
+    """
+
+    def __init__(self, flow, driver, params, actions, default_timeouts):
+        self.flow = flow
+        self.driver = driver
+        self.params = params
+        self.actions = actions
+        self.default_timeouts = default_timeouts
+        self.checkpoints = [Checkpoint(0, driver.current_url, reload=True)]
+        self.timings = {}
+        self.resumes = 0
+        self.index = 0
+
+    @property
+    def done(self):
+        return self.index >= len(self.flow.steps)
+
+    def advance(self):
+        """Run the next step, going back to the latest checkpoint if it fails; raises once out of resumes."""
+        flow, driver = self.flow, self.driver
+        step = flow.steps[self.index]
+        started = time.perf_counter()
+        try:
+            timeout = flow.timeout(step, self.default_timeouts.get(step.action, FLOW_STEP_TIMEOUT))
+            flow.run_step(driver, step, self.params, self.actions, timeout)
+        except ScrapeCancelled:
+            raise
+        except Exception as e:
+            increment('flow_step_failures_total', flow=flow.name, step=step.name)
+            if self.resumes >= flow.max_resumes:
+                raise
+            self.resumes += 1
+            checkpoint = self.checkpoints[-1]
+            if checkpoint.resumed and len(self.checkpoints) > 1:
+                # Resuming from here already failed once, go back one more checkpoint
+                self.checkpoints.pop()
+                checkpoint = self.checkpoints[-1]
+            checkpoint.resumed = True
+            resumed_after = f"after {flow.steps[checkpoint.step - 1].name}" if checkpoint.step else "from the start"
+            logger.warning(f"Step {step.name} of the {flow.name} flow failed ({type(e).__name__}), "
+                           f"resuming {resumed_after}")
+            increment('flow_resumes_total', flow=flow.name)
+            if checkpoint.reload or driver.current_url != checkpoint.url:
+                driver.get(checkpoint.url)
+            self.index = checkpoint.step
+            return
+        elapsed = time.perf_counter() - started
+        self.timings[step.name] = elapsed
+        observe('flow_step_seconds', elapsed, flow=flow.name, step=step.name)
+        self.index += 1
+        if step.checkpoint:
+            self.checkpoints.append(Checkpoint(self.index, driver.current_url))
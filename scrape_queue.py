@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Priority of the searches requested by a user, background refreshes use 0
+INTERACTIVE_PRIORITY = 10
+
+
+class ScrapeQueue(ABC):
+    """
+    Durable queue of scrape jobs shared by the bot front-end and the scraper workers.
+
+    Jobs are deduplicated by (ship, port, capture): enqueueing a search which is
+    already waiting or running adds the chat to that job. A claimed job is leased to
+    a worker; if the worker dies the lease expires and another worker picks the job
+    up again, so every job is delivered at least once.
+    """
+
+    @abstractmethod
+    def enqueue(self, ship_name, port_of_departure, chat_id=None, requester=None, priority=0, capture=True,
+                only_if_changed=False):
+        """Queue a search for the chat and return the id of the job; `chat_id` may be None for a refresh."""
+        pass
+
+    @abstractmethod
+    def claim(self, worker_id, lease_seconds, max_attempts=None):
+        """
+        Lease the next job to a worker, highest priority first. Returns a job dict or None.
+        A job whose lease expired after `max_attempts` attempts is not leased again: it is marked
+        failed and returned with state 'failed', for the worker to tell its chats.
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, job_id, lease_seconds):
+        """Extend the lease of a running job."""
+        pass
+
+    @abstractmethod
+    def chats(self, job_id):
+        """Chats to deliver the result of the job to, as (chat_id, only_if_changed) pairs."""
+        pass
+
+    @abstractmethod
+    def complete(self, job_id, delivered=None):
+        """
+        Mark the job done. Given the chats already answered in `delivered`, a job which other chats
+        joined in the meantime is left running and those chats are returned, to be answered first.
+        """
+        pass
+
+    @abstractmethod
+    def fail(self, job_id, error, max_attempts):
+        """Put the job back in the queue, or mark it failed after `max_attempts`."""
+        pass
+
+    @abstractmethod
+    def remove_chat(self, chat_id):
+        """
+        Drop the chat from the jobs still waiting, deleting those left without chats
+        unless they are background refreshes. Returns the number of jobs affected.
+        """
+        pass
+
+    @abstractmethod
+    def position(self, job_id):
+        """1 based position of a waiting job, 0 once it is running."""
+        pass
+
+
+class SQLiteScrapeQueue(ScrapeQueue):
+    """ScrapeQueue stored in a SQLite database, enough for the workers of a single host."""
+
+    def __init__(self, path="data/scrape_queue.sqlite3"):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dedupe_key TEXT NOT NULL,
+                    ship_name TEXT NOT NULL,
+                    port_of_departure TEXT NOT NULL,
+                    capture INTEGER NOT NULL,
+                    priority INTEGER NOT NULL,
+                    chats TEXT NOT NULL,
+                    requester TEXT,
+                    background INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_until REAL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, state)")
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # IMMEDIATE takes the write lock up front, so two workers never claim the same job
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def enqueue(self, ship_name, port_of_departure, chat_id=None, requester=None, priority=0, capture=True,
+                only_if_changed=False):
+        dedupe_key = json.dumps([ship_name, port_of_departure, bool(capture)])
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id, chats, priority FROM jobs WHERE dedupe_key = ? AND state IN ('queued', 'running')",
+                (dedupe_key,)
+            ).fetchone()
+            if row is not None:
+                chats = self._add_chat(json.loads(row['chats']), chat_id, only_if_changed)
+                db.execute(
+                    "UPDATE jobs SET chats = ?, priority = ?, background = background OR ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(chats), max(priority, row['priority']), int(chat_id is None), now, row['id'])
+                )
+                logger.debug(f"Search {ship_name}-{port_of_departure} joined job {row['id']}")
+                return row['id']
+            chats = self._add_chat([], chat_id, only_if_changed)
+            cursor = db.execute(
+                "INSERT INTO jobs (dedupe_key, ship_name, port_of_departure, capture, priority, chats, requester,"
+                " background, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (dedupe_key, ship_name, port_of_departure, int(bool(capture)), priority, json.dumps(chats), requester,
+                 int(chat_id is None), now, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker_id, lease_seconds, max_attempts=None):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' OR (state = 'running' AND lease_until < ?)"
+                " ORDER BY priority DESC, id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job['capture'] = bool(job['capture'])
+            if row['state'] == 'running':
+                if max_attempts is not None and row['attempts'] >= max_attempts:
+                    # The job killed or hung every worker which ran it, don't hand it to another one
+                    logger.error(f"Lease of job {row['id']} held by {row['worker']} expired after "
+                                 f"{row['attempts']} attempts, marking it failed")
+                    error = f"Lease expired after {row['attempts']} attempts"
+                    db.execute("UPDATE jobs SET state = 'failed', error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                               (error, now, row['id']))
+                    job['state'] = 'failed'
+                    job['error'] = error
+                    return job
+                logger.warning(f"Lease of job {row['id']} held by {row['worker']} expired, claiming it again")
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+                " WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row['id'])
+            )
+            job['state'] = 'running'
+            job['attempts'] += 1
+            return job
+
+    def heartbeat(self, job_id, lease_seconds):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND state = 'running'",
+                       (time.time() + lease_seconds, job_id))
+
+    def chats(self, job_id):
+        row = self._connection().execute("SELECT chats FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return [tuple(chat) for chat in json.loads(row['chats'])] if row else []
+
+    def complete(self, job_id, delivered=None):
+        with self._transaction() as db:
+            if delivered is not None:
+                row = db.execute("SELECT chats FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                answered = {tuple(chat) for chat in delivered}
+                late = [tuple(chat) for chat in json.loads(row['chats']) if tuple(chat) not in answered] if row else []
+                if late:
+                    return late
+            db.execute("UPDATE jobs SET state = 'done', lease_until = NULL, updated_at = ? WHERE id = ?",
+                       (time.time(), job_id))
+        return []
+
+    def fail(self, job_id, error, max_attempts):
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            state = 'failed' if row is None or row['attempts'] >= max_attempts else 'queued'
+            db.execute("UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                       (state, str(error), time.time(), job_id))
+            return state
+
+    def remove_chat(self, chat_id):
+        affected = 0
+        with self._transaction() as db:
+            for row in db.execute("SELECT id, chats, background FROM jobs WHERE state = 'queued'").fetchall():
+                chats = json.loads(row['chats'])
+                remaining = [chat for chat in chats if chat[0] != chat_id]
+                if len(remaining) == len(chats):
+                    continue
+                affected += 1
+                if remaining or row['background']:
+                    db.execute("UPDATE jobs SET chats = ? WHERE id = ?", (json.dumps(remaining), row['id']))
+                else:
+                    db.execute("DELETE FROM jobs WHERE id = ?", (row['id'],))
+        return affected
+
+    def position(self, job_id):
+        db = self._connection()
+        row = db.execute("SELECT state, priority FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row['state'] != 'queued':
+            return 0
+        ahead = db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority > ? OR (priority = ? AND id < ?))",
+            (row['priority'], row['priority'], job_id)
+        ).fetchone()[0]
+        return ahead + 1
+
+    def purge(self, older_than):
+        """Delete the finished jobs older than `older_than` seconds."""
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                       (time.time() - older_than,))
+
+    @staticmethod
+    def _add_chat(chats, chat_id, only_if_changed):
+        if chat_id is None:
+            return chats
+        for chat in chats:
+            if chat[0] == chat_id:
+                # A user asking explicitly always gets the result, even if a refresh only pushes changes
+                chat[1] = chat[1] and only_if_changed
+                return chats
+        chats.append([chat_id, only_if_changed])
+        return chats
@@ -0,0 +1,38 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class CruiseResult:
+    """A single cruise parsed from the JSON responses of the search."""
+    ship: Optional[str] = None
+    port: Optional[str] = None
+    departure_date: Optional[str] = None
+    return_date: Optional[str] = None
+    price: Optional[float] = None
+    currency: Optional[str] = None
+
+
+@dataclass
+class ScrapeResult:
+    """Outcome of a single cruise search: the captured images and the text read from the results."""
+    ship_name: str
+    port_of_departure: str
+    images: List[bytes] = field(default_factory=list)
+    text: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    image_format: str = 'png'  # Encoding of the images, a key of image_tiles.FORMATS
+    network_stats: Dict[str, Any] = field(default_factory=dict)  # Requests and bytes of the run, see request_profiles
+    records: List[CruiseResult] = field(default_factory=list)  # Cruises read from the XHR/fetch responses
+    content_hash: Optional[str] = None  # Hash of the text and records, see change_detection
+    image_hash: Optional[str] = None  # Perceptual hash of the page, see change_detection
+    changed: bool = True  # False when the page is the same as the previous result, whose images are reused
+
+    @property
+    def key(self):
+        return (self.ship_name, self.port_of_departure)
+
+    def age(self):
+        """Seconds elapsed since the search was run."""
+        return time.time() - self.created_at
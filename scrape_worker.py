@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import dataclasses
+import logging
+import os
+import socket
+import threading
+import uuid
+from dotenv import load_dotenv
+from telegram.ext import ExtBot
+from script_selenium import ElementFinderSeleniumBot
+from driver_pool import DriverPool
+from driver_backends import create_backend_from_env
+from session_store import SessionStore
+from result_cache import ResultCache
+from result_sender import send_result, send_cruise_results, send_degraded
+from circuit_breaker import CircuitOpen
+from change_detection import highlight_changes, CHANGE_HIGHLIGHT
+from scrape_queue import SQLiteScrapeQueue
+from send_dispatcher import SendDispatcher, INTERACTIVE, BROADCAST
+from file_id_cache import FileIdCache
+from screenshot_archive import ScreenshotArchive
+from request_profiles import check_profile
+from metrics import start_metrics_server
+
+# Load the .env file
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
+USER = os.getenv('USER')
+PASSWORD = os.getenv('PASSWORD')
+
+HEADLESS = os.getenv('HEADLESS', 'true').lower() == 'true'
+DRIVER_POOL_SIZE = int(os.getenv('DRIVER_POOL_SIZE', '2'))
+DRIVER_POOL_MAX_USES = int(os.getenv('DRIVER_POOL_MAX_USES', '20'))
+DRIVER_POOL_MAX_MEMORY_MB = int(os.getenv('DRIVER_POOL_MAX_MEMORY_MB', '512'))
+PREWARM_BROWSERS = os.getenv('PREWARM_BROWSERS', 'true').lower() == 'true'  # Launch the pooled browsers while the worker connects
+SESSION_FILE = os.getenv('SESSION_FILE', 'sessions/session.json')
+SESSION_MAX_AGE = int(os.getenv('SESSION_MAX_AGE', str(12 * 3600)))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '600'))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '32'))
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'cache/results')
+RESULT_CACHE_DISK_SIZE = int(os.getenv('RESULT_CACHE_DISK_SIZE', '256'))
+RESULTS_REQUEST_PROFILE = os.getenv('RESULTS_REQUEST_PROFILE', 'text_only')
+SCREENSHOT_ARCHIVE_DIR = os.getenv('SCREENSHOT_ARCHIVE_DIR', '')
+FILE_ID_CACHE_FILE = os.getenv('FILE_ID_CACHE_FILE', 'data/file_ids.json')
+FILE_ID_CACHE_TTL = int(os.getenv('FILE_ID_CACHE_TTL', str(30 * 24 * 3600)))
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '2000'))
+
+SCRAPE_QUEUE_FILE = os.getenv('SCRAPE_QUEUE_FILE', 'data/scrape_queue.sqlite3')
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', str(DRIVER_POOL_SIZE)))  # Jobs run at the same time by a worker
+WORKER_LEASE_SECONDS = int(os.getenv('WORKER_LEASE_SECONDS', '120'))  # A job is given to another worker if not renewed in time
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '1'))  # Seconds between two looks at an empty queue
+WORKER_MAX_ATTEMPTS = int(os.getenv('WORKER_MAX_ATTEMPTS', '3'))  # Attempts before a job is marked as failed
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '0'))  # Port of the Prometheus /metrics endpoint, 0 to disable
+
+
+class ScrapeWorker:
+    """
+    Takes scrape jobs from the ScrapeQueue, runs them on the browsers of this
+    process and posts the results to the chats of the job.
+    """
+
+    def __init__(self, scrape_queue, scraper, driver_pool, result_cache, telegram_bot, worker_id, concurrency=1,
+                 file_ids=None, screenshot_archive=None):
+        self.scrape_queue = scrape_queue
+        self.scraper = scraper
+        self.driver_pool = driver_pool
+        self.result_cache = result_cache
+        self.telegram_bot = telegram_bot
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.file_ids = file_ids  # FileIdCache, so every chat after the first gets the images by reference
+        self.screenshot_archive = screenshot_archive  # Optional ScreenshotArchive keeping a copy on disk
+
+    async def run(self):
+        await asyncio.gather(*(self._loop(i) for i in range(self.concurrency)))
+
+    async def _loop(self, slot):
+        worker_id = f"{self.worker_id}/{slot}"
+        while True:
+            job = await asyncio.to_thread(self.scrape_queue.claim, worker_id, WORKER_LEASE_SECONDS, WORKER_MAX_ATTEMPTS)
+            if job is None:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                continue
+            if job['state'] == 'failed':
+                await self.notify_failed(job)
+                continue
+            await self.process(job)
+
+    async def process(self, job):
+        ship_name, port_of_departure = job['ship_name'], job['port_of_departure']
+        logger.info(f"Job {job['id']}: {ship_name}-{port_of_departure} (attempt {job['attempts']})")
+        heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+        try:
+            previous = await asyncio.to_thread(self.result_cache.latest, ship_name, port_of_departure) if job['capture'] else None
+            result = await asyncio.to_thread(
+                self.scraper.run_scrape, ship_name, port_of_departure, headless=HEADLESS, driver_pool=self.driver_pool,
+                request_profile=None if job['capture'] else RESULTS_REQUEST_PROFILE, capture=job['capture'],
+                previous=previous
+            )
+            self.result_cache.put(result)
+            if self.screenshot_archive is not None:
+                self.screenshot_archive.submit(result)
+            await self.deliver_until_complete(job, lambda chats: self.deliver(job, result, previous, chats))
+        except CircuitOpen as e:
+            # Retrying would only fail again, the chats get the last result or a notice straight away
+            logger.warning(f"Job {job['id']} not run: {e}")
+            await self.deliver_until_complete(job, lambda chats: self.deliver_degraded(job, e.retry_after, chats))
+        except Exception as e:
+            state = await asyncio.to_thread(self.scrape_queue.fail, job['id'], e, WORKER_MAX_ATTEMPTS)
+            logger.error(f"Job {job['id']} failed, now {state}: {e}")
+            if state == 'failed':
+                await self.notify_failed(job)
+        finally:
+            heartbeat.cancel()
+
+    async def notify_failed(self, job):
+        """Tell the chats which asked for the failed job, subscribers only hear about changes."""
+        for chat_id, only_if_changed in await asyncio.to_thread(self.scrape_queue.chats, job['id']):
+            if not only_if_changed:
+                await self._send_error(chat_id)
+
+    async def deliver_until_complete(self, job, deliver):
+        """
+        Answer the chats of the job with `deliver(chats)`, then mark it done. Chats which joined the
+        running job meanwhile are answered by another round, so that none of them is left out.
+        Marked done only once every chat got the result, a crash before that runs the job again.
+        """
+        chats = await asyncio.to_thread(self.scrape_queue.chats, job['id'])
+        delivered = []
+        while True:
+            await deliver(chats)
+            delivered.extend(chats)
+            chats = await asyncio.to_thread(self.scrape_queue.complete, job['id'], delivered)
+            if not chats:
+                return
+
+    async def deliver(self, job, result, previous, chats):
+        highlighted = None
+        for chat_id, only_if_changed in chats:
+            try:
+                if not job['capture']:
+                    await send_cruise_results(self.telegram_bot, chat_id, result, priority=INTERACTIVE)
+                elif only_if_changed:
+                    # Subscribers only hear about pages which changed since the previous result
+                    if not result.changed:
+                        continue
+                    if highlighted is None:
+                        highlighted = result
+                        if CHANGE_HIGHLIGHT and previous is not None and previous.images:
+                            images = await asyncio.to_thread(highlight_changes, previous.images, result.images, result.image_format)
+                            highlighted = dataclasses.replace(result, images=images)
+                    await send_result(self.telegram_bot, chat_id, highlighted, priority=BROADCAST, file_ids=self.file_ids)
+                else:
+                    await send_result(self.telegram_bot, chat_id, result, priority=INTERACTIVE, file_ids=self.file_ids)
+            except Exception as e:
+                logger.error(f"Unable to send the result of job {job['id']} to chat {chat_id}: {e}")
+
+    async def deliver_degraded(self, job, retry_after, chats):
+        ship_name, port_of_departure = job['ship_name'], job['port_of_departure']
+        latest = await asyncio.to_thread(self.result_cache.latest, ship_name, port_of_departure, with_images=job['capture'])
+        for chat_id, only_if_changed in chats:
+            if only_if_changed:
+                continue
+            try:
+                await send_degraded(self.telegram_bot, chat_id, ship_name, port_of_departure, latest, retry_after,
+                                    capture=job['capture'], file_ids=self.file_ids)
+            except Exception as e:
+                logger.error(f"Unable to send the degraded answer of job {job['id']} to chat {chat_id}: {e}")
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(WORKER_LEASE_SECONDS / 3)
+            await asyncio.to_thread(self.scrape_queue.heartbeat, job_id, WORKER_LEASE_SECONDS)
+
+    async def _send_error(self, chat_id):
+        try:
+            await self.telegram_bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+        except Exception as e:
+            logger.error(f"Unable to notify chat {chat_id}: {e}")
+
+
+async def run_worker(concurrency) -> None:
+    scraper = ElementFinderSeleniumBot(USER, PASSWORD, SessionStore(SESSION_FILE, max_age=SESSION_MAX_AGE),
+                                       driver_backend=create_backend_from_env())
+    driver_pool = DriverPool(
+        lambda: scraper.create_logged_in_driver(headless=HEADLESS),
+        size=max(DRIVER_POOL_SIZE, concurrency),
+        max_uses=DRIVER_POOL_MAX_USES,
+        max_memory_mb=DRIVER_POOL_MAX_MEMORY_MB,
+        destroy=scraper.quit_driver
+    )
+    result_cache = ResultCache(
+        ttl=RESULT_CACHE_TTL,
+        max_entries=RESULT_CACHE_SIZE,
+        disk_dir=RESULT_CACHE_DIR,
+        max_disk_entries=RESULT_CACHE_DISK_SIZE
+    )
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    scrape_queue = SQLiteScrapeQueue(SCRAPE_QUEUE_FILE)
+    # Jobs finished more than a day ago are only kept for debugging
+    await asyncio.to_thread(scrape_queue.purge, 24 * 3600)
+    telegram_bot = ExtBot(token=API_TOKEN, base_url=TELEGRAM_BASE_URL, rate_limiter=SendDispatcher())
+    async with telegram_bot:
+        file_ids = FileIdCache(FILE_ID_CACHE_FILE, ttl=FILE_ID_CACHE_TTL, max_entries=FILE_ID_CACHE_SIZE)
+        screenshot_archive = ScreenshotArchive(SCREENSHOT_ARCHIVE_DIR) if SCREENSHOT_ARCHIVE_DIR else None
+        worker = ScrapeWorker(scrape_queue, scraper, driver_pool, result_cache, telegram_bot, worker_id, concurrency,
+                              file_ids, screenshot_archive)
+        if PREWARM_BROWSERS:
+            # Jobs are claimed right away, the first ones wait for the first browser of the pool
+            threading.Thread(target=driver_pool.warm, name='driver-prewarm', daemon=True).start()
+        logger.info(f"Scrape worker {worker_id} started with {concurrency} slots")
+        try:
+            await worker.run()
+        finally:
+            await asyncio.to_thread(driver_pool.close)
+            await asyncio.to_thread(result_cache.close)
+            if screenshot_archive is not None:
+                await asyncio.to_thread(screenshot_archive.close)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the scrape jobs queued by telegram_bot_conn.py in SCRAPE_MODE=queue")
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help="Jobs run at the same time")
+    parser.add_argument('--metrics-port', type=int, default=WORKER_METRICS_PORT, help="Port of the /metrics endpoint")
+    args = parser.parse_args()
+    # REQUEST_PROFILE is checked by the scraper itself
+    check_profile(RESULTS_REQUEST_PROFILE)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    asyncio.run(run_worker(args.concurrency))
+
+if __name__ == '__main__':
+    main()
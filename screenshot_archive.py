@@ -0,0 +1,43 @@
+import datetime
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from image_tiles import file_extension
+
+logger = logging.getLogger(__name__)
+
+
+class ScreenshotArchive:
+    """
+    Keeps a copy of every new screenshot on disk, written on a background thread
+    so that the reply to the user never waits for the disk.
+    """
+
+    def __init__(self, folder="screenshots"):
+        self.folder = folder
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+
+    def submit(self, result):
+        """Queue the tiles of a ScrapeResult for writing; unchanged or text only results are skipped."""
+        if not result.images or not result.changed:
+            return
+        self._writer.submit(self._write, result)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+    def _write(self, result):
+        try:
+            name = re.sub(r'[^A-Za-z0-9]+', '_', f"{result.ship_name}-{result.port_of_departure}").strip('_')
+            timestamp = datetime.datetime.fromtimestamp(result.created_at).strftime("%Y%m%d_%H%M%S")
+            folder = os.path.join(self.folder, name)
+            os.makedirs(folder, exist_ok=True)
+            extension = file_extension(result.image_format)
+            for i, image in enumerate(result.images):
+                with open(os.path.join(folder, f"{timestamp}_{i}.{extension}"), 'wb') as f:
+                    f.write(image)
+            logger.debug(f"{len(result.images)} screenshot tiles archived in {folder}")
+        except OSError as e:
+            logger.warning(f"Unable to archive the screenshot of {result.key}: {e}")
@@ -1,19 +1,30 @@
 from dotenv import load_dotenv
-from selenium import webdriver
 from PIL import Image
 from io import BytesIO
 from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+from selenium.common.exceptions import TimeoutException
 import time
-import datetime
 import os
 import logging
 import asyncio
+import base64
+import math
+from cdp import execute_cdp, read_performance_events, read_performance_events_by_target, current_target_id
+from request_profiles import apply_profile, check_profile, network_stats
+from results_extractor import extract_cruise_results
+from change_detection import content_hash, image_hash, is_unchanged
+from image_tiles import (TileEncoder, SCREENSHOT_FORMAT, SCREENSHOT_QUALITY, SCREENSHOT_MIN_QUALITY,
+                         SCREENSHOT_MAX_TILE_BYTES, tile_size)
+from session_store import SessionStore
+from driver_backends import LocalChromeBackend, create_backend_from_env
+from scrape_result import ScrapeResult
+from scrape_executor import ScrapeCancelled
+from metrics import timer, increment
+from scrape_flow import load_flows
+from circuit_breaker import CircuitBreaker, CircuitOpen
 
 # Set up logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
@@ -32,44 +43,120 @@ os.environ.pop('Password', None)
 # Load the .env file
 load_dotenv()
 
-local_path_screenshot = "screenshots/full_page_screenshot.png"
+TARGET_URL = os.getenv('TARGET_URL', 'https://www.your_page_placeholder.org/')
+# 'cdp' captures the full page with one DevTools call per tile, 'stitch' scrolls the viewport and stitches the pieces,
+# 'element' only captures the elements of CAPTURE_ELEMENTS
+CAPTURE_MODE = os.getenv('CAPTURE_MODE', 'cdp')
+# XPath of the elements captured in 'element' mode, e.g. the results container or "//div[@class='card']";
+# every match is captured and they are stacked in a single image
+CAPTURE_ELEMENTS = os.getenv('CAPTURE_ELEMENTS', "//div[@data='PLACEHOLDER']")
+# Pixels of the page kept around every captured element, and between two stacked elements
+CAPTURE_PADDING = int(os.getenv('CAPTURE_PADDING', '16'))
+
+# Width of the thumbnail used to tell whether the page changed since the previous result
+THUMBNAIL_WIDTH = 256
+
+# Requests blocked while scraping, one of request_profiles.PROFILES
+REQUEST_PROFILE = os.getenv('REQUEST_PROFILE', 'block_trackers')
+
+# Seconds without XHR/fetch traffic after which the page is considered loaded
+NETWORK_QUIET_WINDOW = float(os.getenv('NETWORK_QUIET_WINDOW', '0.5'))
+# Maximum seconds to wait for the network to become idle
+NETWORK_IDLE_TIMEOUT = float(os.getenv('NETWORK_IDLE_TIMEOUT', '30'))
+
+# Injected in every page to count the XHR/fetch requests in flight
+NETWORK_TRACKER_JS = """
+(function() {
+    if (window.__networkTracker) {
+        return;
+    }
+    var tracker = window.__networkTracker = {pending: 0, lastActivity: Date.now()};
+    function started() {
+        tracker.pending++;
+        tracker.lastActivity = Date.now();
+    }
+    function finished() {
+        tracker.pending = Math.max(0, tracker.pending - 1);
+        tracker.lastActivity = Date.now();
+    }
+
+    var send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function() {
+        started();
+        this.addEventListener('loadend', finished);
+        return send.apply(this, arguments);
+    };
+
+    var fetch = window.fetch;
+    if (fetch) {
+        window.fetch = function() {
+            started();
+            return fetch.apply(this, arguments).then(function(response) {
+                finished();
+                return response;
+            }, function(error) {
+                finished();
+                throw error;
+            });
+        };
+    }
+})();
+"""
+
+# Element which is only shown once the user is logged in
+LOGGED_IN_XPATH = "//a[contains(text(), 'Find some html element before proceeding')]"
 
 # Now the environment variables should be updated
 User = os.getenv('User')
 Password = os.getenv('Password')
 
 class ElementFinderSeleniumBot:
-    def __init__(self, user, password):
+    def __init__(self, user, password, session_store=None, capture_mode=CAPTURE_MODE, request_profile=REQUEST_PROFILE,
+                 driver_backend=None, flows=None, circuit_breaker=None):
         self.user = user
         self.password = password
-        self._screenshot_path = None  # Initialize the screenshot path
-
-    def check_printscreen_folder(self, folder_path):
-        # Check if the folder exists
-        if not os.path.exists(folder_path):
-            # Create the folder
-            os.makedirs(folder_path)
-            logger.debug(f'Folder "{folder_path}" created.')
-        else:
-            logger.debug(f'Folder "{folder_path}" already exists.')
-        
-    # Function to wait for the network to be idle
-    def wait_for_network_idle(self, driver, timeout=30):
-        driver.execute_script("""
-            var callback = arguments[arguments.length - 1];
-            var xhr = new XMLHttpRequest();
-            xhr.open('GET', '/');
-            xhr.onreadystatechange = function() {
-                if (xhr.readyState == 4) {
-                    console.log("Network is idle");
-                    callback();
+        self.session_store = session_store  # Optional SessionStore used to skip the login form
+        self.capture_mode = capture_mode  # 'cdp' for one DevTools capture per tile, 'stitch' to scroll and stitch
+        self.request_profile = request_profile  # Default request_profiles.PROFILES entry applied to every scrape
+        self.driver_backend = driver_backend or LocalChromeBackend()  # Where the browsers are launched, see driver_backends
+        self.flows = flows or load_flows()  # {name: ScrapeFlow} with the 'login' and 'search' steps, see scrape_flow
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()  # Refuses the scrapes while the site keeps failing
+        # A mistyped REQUEST_PROFILE fails here instead of failing every scrape
+        check_profile(self.request_profile)
+
+    # Count the XHR/fetch requests in flight on every page loaded by the browser
+    def install_network_tracker(self, driver):
+        try:
+            execute_cdp(driver, "Page.addScriptToEvaluateOnNewDocument", {"source": NETWORK_TRACKER_JS})
+        except Exception as e:
+            # Without DevTools the tracker is injected by wait_for_network_idle, missing the requests already started
+            logger.debug(f"Unable to install the network tracker on new documents: {e}")
+
+    # Function to wait for the network to be idle: no XHR/fetch in flight for `quiet_window` seconds.
+    # Raises TimeoutException after `timeout` seconds, so that the flow step fails and is retried
+    def wait_for_network_idle(self, driver, timeout=NETWORK_IDLE_TIMEOUT, quiet_window=NETWORK_QUIET_WINDOW):
+        with timer('scrape_stage_seconds', stage='network_idle'):
+            self._wait_for_network_idle(driver, timeout, quiet_window)
+
+    def _wait_for_network_idle(self, driver, timeout, quiet_window):
+        deadline = time.monotonic() + timeout
+        while True:
+            state = driver.execute_script("""
+                if (!window.__networkTracker) {
+                    eval(arguments[0]);
                 }
-            };
-            xhr.send();
-        """)
-        WebDriverWait(driver, timeout).until(
-            lambda d: d.execute_script('return document.readyState') == 'complete'
-        )
+                var tracker = window.__networkTracker;
+                return {
+                    readyState: document.readyState,
+                    pending: tracker.pending,
+                    idleFor: Date.now() - tracker.lastActivity
+                };
+            """, NETWORK_TRACKER_JS)
+            if state['readyState'] == 'complete' and state['pending'] == 0 and state['idleFor'] >= quiet_window * 1000:
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutException(f"Network still busy after {timeout:.1f}s ({state['pending']} requests in flight)")
+            time.sleep(0.1)
 
     def log_http_requests(self, driver):
         driver.execute_script("""
@@ -104,114 +191,448 @@ class ElementFinderSeleniumBot:
             })();
         """)
 
-    # Function to take a screenshot
-    def take_screenshot(self, driver):
-        self.check_printscreen_folder("screenshots")
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"screenshots/screenshot_{timestamp}.png"
-        driver.get_screenshot_as_file(filename)
-        logger.debug(f"Screenshot salvato come {filename}")
-        self._screenshot_path = filename  # Store the screenshot path
-
-    # Function to take a full page screenshot with particular scrolling
-    def get_full_page_screenshot(self, driver, file_path):
-        # Scroll to the top of the page
+    # Capture the page as encoded tiles of fixed height, one DevTools capture per tile
+    def get_tiled_screenshot_cdp(self, driver, fmt=SCREENSHOT_FORMAT, quality=SCREENSHOT_QUALITY):
+        metrics = execute_cdp(driver, "Page.getLayoutMetrics")
+        content_size = metrics.get('cssContentSize') or metrics['contentSize']
+        # A page too wide for Telegram is cut on the right, see image_tiles.tile_size
+        width, tile_height = tile_size(math.ceil(content_size['width']))
+        height = math.ceil(content_size['height'])
+
+        tiles = []
+        for top in range(0, height, tile_height):
+            clip = {"x": 0, "y": top, "width": width, "height": min(tile_height, height - top), "scale": 1}
+            tile_quality = quality
+            while True:
+                params = {"format": fmt, "captureBeyondViewport": True, "clip": clip}
+                if fmt != 'png':
+                    params["quality"] = tile_quality
+                data = base64.b64decode(execute_cdp(driver, "Page.captureScreenshot", params)['data'])
+                # Chrome encodes the tile, so lowering the quality is just another capture
+                if fmt == 'png' or len(data) <= SCREENSHOT_MAX_TILE_BYTES or tile_quality <= SCREENSHOT_MIN_QUALITY:
+                    break
+                tile_quality = max(SCREENSHOT_MIN_QUALITY, tile_quality - 10)
+            tiles.append(data)
+        return tiles
+
+    # Capture the page as encoded tiles scrolling the viewport, only one tile is kept in memory
+    def get_tiled_screenshot_stitch(self, driver, fmt=SCREENSHOT_FORMAT, quality=SCREENSHOT_QUALITY):
         driver.execute_script("window.scrollTo(0, 0);")
-        # Get the total height of the page
         total_height = driver.execute_script("return document.body.scrollHeight")
-        # Get the viewport height
         viewport_height = driver.execute_script("return window.innerHeight")
-        # Initialize the stitched image
-        stitched_image = Image.new('RGB', (driver.execute_script("return document.body.scrollWidth"), total_height))
+        encoder = TileEncoder(driver.execute_script("return document.body.scrollWidth"), fmt=fmt, quality=quality)
 
         for offset in range(0, total_height, viewport_height):
             driver.execute_script(f"window.scrollTo(0, {offset});")
             time.sleep(0.2)
+            # The last scroll stops at the bottom of the page, so skip the rows already added
+            scroll_y = driver.execute_script("return window.scrollY")
+            rows = min(viewport_height, total_height - offset)
             screenshot = Image.open(BytesIO(driver.get_screenshot_as_png()))
-            stitched_image.paste(screenshot, (0, offset))
-        # Save the stitched image
-        stitched_image.save(file_path)
-    # end of get_full_page_screenshot
+            top = offset - scroll_y
+            encoder.add_strip(screenshot.crop((0, top, screenshot.width, top + rows)))
+        return encoder.finish()
+
+    # Capture only the elements matching `xpath`, stacked in encoded tiles, one DevTools capture per piece
+    def get_element_tiles(self, driver, xpath=CAPTURE_ELEMENTS, padding=CAPTURE_PADDING, fmt=SCREENSHOT_FORMAT,
+                          quality=SCREENSHOT_QUALITY):
+        elements = driver.find_elements(By.XPATH, xpath)
+        metrics = execute_cdp(driver, "Page.getLayoutMetrics")
+        content_size = metrics.get('cssContentSize') or metrics['contentSize']
+        page_width = math.ceil(content_size['width'])
+        page_height = math.ceil(content_size['height'])
+
+        clips = []
+        for element in elements:
+            # Bring the element on screen first, so that its lazy loaded content is there
+            rect = driver.execute_script("""
+                arguments[0].scrollIntoView({block: 'start'});
+                var rect = arguments[0].getBoundingClientRect();
+                return {x: rect.left + window.scrollX, y: rect.top + window.scrollY, width: rect.width, height: rect.height};
+            """, element)
+            if rect['width'] < 1 or rect['height'] < 1:
+                continue
+            left = max(0, math.floor(rect['x']) - padding)
+            top = max(0, math.floor(rect['y']) - padding)
+            right = min(page_width, math.ceil(rect['x'] + rect['width']) + padding)
+            bottom = min(page_height, math.ceil(rect['y'] + rect['height']) + padding)
+            clips.append((left, top, right, bottom))
+        # Cards inside a captured container are already in its image
+        clips = [clip for clip in clips
+                 if not any(other != clip and other[0] <= clip[0] and other[1] <= clip[1]
+                            and other[2] >= clip[2] and other[3] >= clip[3] for other in clips)]
+        clips = sorted(set(clips), key=lambda clip: (clip[1], clip[0]))
+        if not clips:
+            raise ValueError(f"No visible element matches {xpath}")
+
+        encoder = TileEncoder(max(right - left for left, _, right, _ in clips), fmt=fmt, quality=quality)
+        for i, (left, top, right, bottom) in enumerate(clips):
+            if i > 0 and padding:
+                encoder.add_strip(Image.new('RGB', (encoder.width, padding), 'white'))
+            # Tall elements are captured in pieces, so only one of them is decoded at a time
+            for piece_top in range(top, bottom, encoder.tile_height):
+                screenshot = execute_cdp(driver, "Page.captureScreenshot", {
+                    "format": "png",
+                    "captureBeyondViewport": True,
+                    "clip": {"x": left, "y": piece_top, "width": min(right - left, encoder.width),
+                             "height": min(encoder.tile_height, bottom - piece_top), "scale": 1},
+                })
+                encoder.add_strip(Image.open(BytesIO(base64.b64decode(screenshot['data']))))
+        logger.debug(f"Captured {len(clips)} elements matching {xpath}")
+        return encoder.finish()
+
+    # Capture a small, cheap, image of the whole page used for the perceptual hash
+    def capture_thumbnail(self, driver, width=THUMBNAIL_WIDTH):
+        try:
+            metrics = execute_cdp(driver, "Page.getLayoutMetrics")
+            content_size = metrics.get('cssContentSize') or metrics['contentSize']
+            scale = min(1, width / content_size['width'])
+            screenshot = execute_cdp(driver, "Page.captureScreenshot", {
+                "format": "jpeg",
+                "quality": 50,
+                "captureBeyondViewport": True,
+                "clip": {"x": 0, "y": 0, "width": content_size['width'], "height": content_size['height'], "scale": scale},
+            })
+            return base64.b64decode(screenshot['data'])
+        except Exception as e:
+            logger.debug(f"DevTools thumbnail failed, using the viewport: {e}")
+            return driver.get_screenshot_as_png()
+
+    # Capture the page as tiles with the configured capture mode, falling back to the full page and to the stitcher
+    def capture_tiles(self, driver):
+        with timer('scrape_stage_seconds', stage='capture'):
+            if self.capture_mode == 'element':
+                try:
+                    return self.get_element_tiles(driver)
+                except Exception as e:
+                    logger.debug(f"Element capture failed, capturing the full page: {e}")
+            if self.capture_mode in ('cdp', 'element'):
+                try:
+                    return self.get_tiled_screenshot_cdp(driver)
+                except Exception as e:
+                    logger.debug(f"DevTools capture failed, falling back to scroll and stitch: {e}")
+            return self.get_tiled_screenshot_stitch(driver)
 
-    # main function to run the script
-    async def run_script_on_selenium(self, headless=False):
+    # Create a new browser with the configured options
+    def create_driver(self, headless=False):
         # Configure Chrome options
         chrome_options = Options()
         if headless:
             chrome_options.add_argument("--headless")
         # chrome_options.add_argument("--start-fullscreen")  # Start Chrome in fullscreen mode
+        # Record the DevTools network events, used for the statistics of the request profiles
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
 
         # Initialize the driver with the configured options
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
-        
-        # Accedi alla pagina di login TO CHANGE
-        driver.get('https://www.your_page_placeholder.org/')
-
-        # self.log_http_requests(driver)
-        
-        # Trova e clicca il pulsante "Login"
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//button[contains(text(), 'Login')]")))
-        login_button = driver.find_element(By.XPATH, "//button[contains(text(), 'Login')]")
-        login_button.click()
-
-        # Attendi il caricamento della pagina successiva
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'email')))
-
-        logger.debug(f"Read the .env file --> Email: {self.user} and Password: {self.password}")
-        # Compila il form di login
-        email = driver.find_element(By.ID, 'EMAIL')
-        password = driver.find_element(By.ID, 'PASSWORD')
-        email.send_keys(self.user)
-        password.send_keys(self.password)
-        password.send_keys(Keys.RETURN)
-
-        SignInXPathSelector = "//button[contains(text(), 'Sign in')]"
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, SignInXPathSelector)))
-        button = driver.find_element(By.XPATH, SignInXPathSelector)
-        button.click()
-
-        # Wait an element to be present before proceeding
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//a[contains(text(), 'Find some html element before proceeding')]")))
-
-        # click on the element
-        driver.find_element(By.ID, "PLACEHOLDER").click()
-
-        # Wait until the network is idle
-        self.wait_for_network_idle(driver)
-
-        # Find and click the modify search button
-        modify_search_button = driver.find_element(By.XPATH, "//button[@data='SearchButton']")
-        modify_search_button.click()
-
-        # Attendi fino a quando la rete è inattiva
-        self.wait_for_network_idle(driver)
-
-        await asyncio.sleep(5)  # Wait 5 seconds before taking the screenshot
-        # self.take_full_page_screenshot(driver)
-        self.get_full_page_screenshot(driver, local_path_screenshot)
-        logger.debug(f"Screenshot saved on path {local_path_screenshot}")
+        driver = self.driver_backend.create(chrome_options)
+        self.install_network_tracker(driver)
+        return driver
+
+    # Apply the request profile of the scrape and forget the network events of previous runs
+    def prepare_driver(self, driver, request_profile=None):
+        try:
+            apply_profile(driver, request_profile or self.request_profile)
+            read_performance_events(driver)
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.debug(f"Unable to apply the request profile: {e}")
+
+    # Check whether the page loaded in the browser belongs to a logged in user
+    def is_logged_in(self, driver, timeout=5):
+        try:
+            WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.XPATH, LOGGED_IN_XPATH)))
+            return True
+        except TimeoutException:
+            return False
+
+    # Log in on the target page, reusing the saved session when the site still accepts it
+    def login(self, driver):
+        with timer('scrape_stage_seconds', stage='login'):
+            self._login(driver)
+
+    def _login(self, driver):
+        if self.session_store is not None and self.session_store.restore(driver, TARGET_URL):
+            if self.is_logged_in(driver):
+                logger.debug("Logged in with the saved session")
+                return
+            logger.debug("Saved session has expired, falling back to the login form")
+            self.session_store.clear()
+        self.login_with_form(driver)
+        if self.session_store is not None:
+            self.session_store.save(driver)
+
+    # Log in on the target page filling the login form with the credentials of the bot
+    def login_with_form(self, driver):
+        self.run_flow('login', driver)
+
+    # Run one of the flows of the scraper, filling its placeholders with the credentials and the search
+    def run_flow(self, name, driver, ship_name=None, port_of_departure=None, cancel_event=None):
+        params, actions, default_timeouts = self.flow_args(ship_name, port_of_departure)
+        return self.flows[name].run(driver, params, cancel_event, actions, default_timeouts)
+
+    # Placeholders, extra actions and default timeouts of the flows
+    def flow_args(self, ship_name=None, port_of_departure=None):
+        params = {
+            'target_url': TARGET_URL,
+            'user': self.user,
+            'password': self.password,
+            'ship_name': ship_name,
+            'port_of_departure': port_of_departure,
+        }
+        actions = {
+            'wait_network_idle': lambda driver, step, timeout: self.wait_for_network_idle(driver, timeout=timeout),
+        }
+        return params, actions, {'wait_network_idle': NETWORK_IDLE_TIMEOUT}
+
+    # Create a browser which is already logged in, used as factory by the DriverPool
+    def create_logged_in_driver(self, headless=False):
+        driver = self.create_driver(headless)
+        try:
+            self.login(driver)
+        except Exception:
+            self.quit_driver(driver)
+            raise
+        return driver
+
+    # Close a browser created by create_driver, giving it back to its backend
+    def quit_driver(self, driver):
+        self.driver_backend.release(driver)
+
+    # Bring a reused browser back to the logged in landing page, logging in again if the session expired
+    def return_to_start_page(self, driver):
+        with timer('scrape_stage_seconds', stage='start_page'):
+            driver.get(TARGET_URL)
+        if not self.is_logged_in(driver, timeout=10):
+            logger.debug("Session of the pooled browser expired, logging in again")
+            self.login(driver)
+
+    # Search for the cruise and return the text and the screenshot of the results as a ScrapeResult
+    def search_and_capture(self, driver, ship_name=None, port_of_departure=None, cancel_event=None, capture=True,
+                           previous=None):
+        logger.debug(f"Searching cruises for Ship name: {ship_name} and Port of Departure: {port_of_departure}")
+        # Open the filters and run the search, a failing step resumes from the last checkpoint of the flow
+        self.run_flow('search', driver, ship_name, port_of_departure, cancel_event)
+        self.check_cancelled(cancel_event)
+        return self.collect_result(driver, ship_name, port_of_departure, capture=capture, previous=previous)
+
+    # Read the results of the search loaded in the current tab, `events` are its DevTools events when already read
+    def collect_result(self, driver, ship_name, port_of_departure, events=None, capture=True, previous=None):
+        stats = {}
+        records = []
+        try:
+            with timer('scrape_stage_seconds', stage='extract'):
+                if events is None:
+                    events = read_performance_events(driver)
+                stats = network_stats(events)
+                logger.info(f"Network of {ship_name}-{port_of_departure}: {stats['requests']} requests, "
+                            f"{stats['bytes_downloaded']} bytes downloaded, {stats['requests_blocked']} requests blocked "
+                            f"saving about {stats['estimated_bytes_saved']} bytes")
+                records = extract_cruise_results(driver, events, ship_name, port_of_departure)
+        except Exception as e:
+            logger.debug(f"Unable to read the network events: {e}")
 
         # Find the desired element
+        text = None
         try:
             element = driver.find_element(By.XPATH, "//div[@data='PLACEHOLDER']")
-            logger.debug(f"The element has been found: {element.text}")
+            text = element.text
+            logger.debug(f"The element has been found: {text}")
         except:
             logger.debug("No element found in page")
-            
-        # close the browser
-        driver.quit()
 
-    def get_screenshot_path(self):
-        """Getter for the screenshot path."""
-        return self._screenshot_path
+        # Text only searches skip the screenshot and answer with the records read from the network
+        images = []
+        changed = True
+        page_hash = None
+        text_hash = content_hash(text, records)
+        if capture:
+            try:
+                with timer('scrape_stage_seconds', stage='thumbnail'):
+                    page_hash = image_hash(self.capture_thumbnail(driver))
+            except Exception as e:
+                logger.debug(f"Unable to compute the perceptual hash of the page: {e}")
+            if page_hash is not None and is_unchanged(previous, text_hash, page_hash):
+                # Nothing changed since the previous result: skip the capture and the encoding of the tiles
+                logger.info(f"{ship_name}-{port_of_departure} did not change, reusing the previous screenshot")
+                images = previous.images
+                changed = False
+                increment('scrapes_unchanged_total')
+            else:
+                # self.take_full_page_screenshot(driver)
+                images = self.capture_tiles(driver)
+
+        return ScrapeResult(ship_name, port_of_departure, images, text, image_format=SCREENSHOT_FORMAT,
+                            network_stats=stats, records=records, content_hash=text_hash, image_hash=page_hash,
+                            changed=changed)
+
+    # Stop the scrape if it has been cancelled while waiting on the browser
+    def check_cancelled(self, cancel_event):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ScrapeCancelled("Scrape cancelled")
+
+    # Blocking version of the scrape, meant to run on a worker thread of the ScrapeExecutor.
+    # Raises CircuitOpen without touching a browser while the site is considered down
+    def run_scrape(self, ship_name=None, port_of_departure=None, headless=False, driver_pool=None, cancel_event=None,
+                   request_profile=None, capture=True, previous=None):
+        # A wrong profile is a bug of the caller, not a failure of the site, so it never reaches the circuit breaker
+        check_profile(request_profile or self.request_profile)
+        outcome = 'error'
+        try:
+            self.circuit_breaker.check()
+            with timer('scrape_seconds', pooled=driver_pool is not None, capture=capture):
+                result = self._run_scrape(ship_name, port_of_departure, headless, driver_pool, cancel_event,
+                                          request_profile, capture, previous)
+            outcome = 'ok'
+            self.circuit_breaker.record_success()
+            return result
+        except CircuitOpen:
+            outcome = 'refused'
+            raise
+        except ScrapeCancelled:
+            outcome = 'cancelled'
+            self.circuit_breaker.record_cancelled()
+            raise
+        except Exception:
+            self.circuit_breaker.record_failure()
+            raise
+        finally:
+            increment('scrapes_total', outcome=outcome)
+
+    def _run_scrape(self, ship_name, port_of_departure, headless, driver_pool, cancel_event, request_profile, capture,
+                    previous):
+        # Borrow a warm, already logged in browser when a pool is available
+        if driver_pool is not None:
+            with driver_pool.session() as driver:
+                self.prepare_driver(driver, request_profile)
+                self.return_to_start_page(driver)
+                return self.search_and_capture(driver, ship_name, port_of_departure, cancel_event, capture, previous)
+
+        driver = self.create_driver(headless)
+        try:
+            self.prepare_driver(driver, request_profile)
+            self.login(driver)
+            return self.search_and_capture(driver, ship_name, port_of_departure, cancel_event, capture, previous)
+        finally:
+            # close the browser
+            self.quit_driver(driver)
+
+    # Search several ship/port combinations in a single logged in browser, one tab each.
+    # Returns a ScrapeResult, or the exception which stopped it, per combination and in the same order
+    def run_batch(self, combinations, headless=False, driver_pool=None, cancel_event=None, request_profile=None,
+                  capture=True, previous=None):
+        check_profile(request_profile or self.request_profile)
+        self.circuit_breaker.check()
+        try:
+            with timer('batch_seconds', pooled=driver_pool is not None):
+                results = self._run_batch(combinations, headless, driver_pool, cancel_event, request_profile, capture,
+                                          previous)
+        except ScrapeCancelled:
+            self.circuit_breaker.record_cancelled()
+            increment('scrapes_total', len(combinations), outcome='cancelled')
+            raise
+        except Exception:
+            self.circuit_breaker.record_failure()
+            increment('scrapes_total', len(combinations), outcome='error')
+            raise
+        failed = sum(isinstance(result, Exception) for result in results)
+        if failed == len(results):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        increment('scrapes_total', len(results) - failed, outcome='ok')
+        increment('scrapes_total', failed, outcome='error')
+        return results
+
+    def _run_batch(self, combinations, headless, driver_pool, cancel_event, request_profile, capture, previous):
+        if driver_pool is not None:
+            with driver_pool.session() as driver:
+                self.prepare_driver(driver, request_profile)
+                self.return_to_start_page(driver)
+                return self.search_in_tabs(driver, combinations, cancel_event, request_profile, capture, previous)
+
+        driver = self.create_driver(headless)
+        try:
+            self.prepare_driver(driver, request_profile)
+            self.login(driver)
+            return self.search_in_tabs(driver, combinations, cancel_event, request_profile, capture, previous)
+        finally:
+            self.quit_driver(driver)
+
+    # Run the search flow of every combination in its own tab, a step of each tab in turn so that
+    # the pages of all the tabs load at the same time, then collect the results tab by tab
+    def search_in_tabs(self, driver, combinations, cancel_event=None, request_profile=None, capture=True, previous=None):
+        previous = previous or {}
+        first_tab = driver.current_window_handle
+        tabs = []
+        results = [None] * len(combinations)
+        try:
+            for i, (ship_name, port_of_departure) in enumerate(combinations):
+                if i > 0:
+                    # The tracker and the blocked URLs are set per tab, the cookies of the login are shared
+                    driver.switch_to.new_window('tab')
+                    self.install_network_tracker(driver)
+                    self.prepare_driver(driver, request_profile)
+                    with timer('scrape_stage_seconds', stage='start_page'):
+                        driver.get(TARGET_URL)
+                params, actions, default_timeouts = self.flow_args(ship_name, port_of_departure)
+                tabs.append((driver.current_window_handle, self.flows['search'].start(driver, params, actions, default_timeouts)))
+
+            pending = list(range(len(tabs)))
+            while pending:
+                self.check_cancelled(cancel_event)
+                for i in list(pending):
+                    handle, flow_run = tabs[i]
+                    driver.switch_to.window(handle)
+                    try:
+                        flow_run.advance()
+                    except ScrapeCancelled:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"Search of {combinations[i][0]}-{combinations[i][1]} failed in its tab: {e}")
+                        results[i] = e
+                    if results[i] is not None or flow_run.done:
+                        pending.remove(i)
+
+            events = {}
+            try:
+                events = read_performance_events_by_target(driver)
+            except Exception as e:
+                logger.debug(f"Unable to read the network events: {e}")
+            for i, (handle, _) in enumerate(tabs):
+                if results[i] is not None:
+                    continue
+                self.check_cancelled(cancel_event)
+                ship_name, port_of_departure = combinations[i]
+                driver.switch_to.window(handle)
+                try:
+                    tab_events = events.get(current_target_id(driver), []) if events else None
+                except Exception as e:
+                    logger.debug(f"Unable to tell the DevTools target of the tab: {e}")
+                    tab_events = []
+                try:
+                    results[i] = self.collect_result(driver, ship_name, port_of_departure, tab_events, capture,
+                                                     previous.get((ship_name, port_of_departure)))
+                except Exception as e:
+                    logger.warning(f"Unable to collect the results of {ship_name}-{port_of_departure}: {e}")
+                    results[i] = e
+        finally:
+            # A pooled browser goes back with its first tab only
+            for handle, _ in tabs:
+                if handle != first_tab:
+                    driver.switch_to.window(handle)
+                    driver.close()
+            driver.switch_to.window(first_tab)
+        return results
 
-    def set_screenshot_path(self, path):
-        """Setter for the screenshot path."""
-        self._screenshot_path = path
+    # main function to run the script, the blocking work runs on a separate thread.
+    # Every call gets its own ScrapeResult, the images never leave memory
+    async def run_script_on_selenium(self, ship_name=None, port_of_departure=None, headless=False, driver_pool=None):
+        return await asyncio.to_thread(self.run_scrape, ship_name, port_of_departure, headless, driver_pool)
 
 def main() -> None:
     # Esegui la funzione ogni 5 minuti
-    bot = ElementFinderSeleniumBot(User, Password)
+    bot = ElementFinderSeleniumBot(User, Password, SessionStore(), driver_backend=create_backend_from_env())
     while True:
         asyncio.run(bot.run_script_on_selenium(headless=False))
         time.sleep(300)  # 300 secondi = 5 minuti
@@ -0,0 +1,224 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Priorities passed as rate_limit_args={'priority': ...}, lower goes first
+INTERACTIVE = 0  # Replies to a command
+BROADCAST = 1  # Updates pushed to subscribers
+
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '25'))  # Messages per second for the whole bot, Telegram allows about 30
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))  # Messages per second to a single private chat
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))  # Messages sent to a chat at once before SEND_CHAT_RATE applies
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', '20'))  # Messages per minute to a group
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+SEND_METRICS_INTERVAL = int(os.getenv('SEND_METRICS_INTERVAL', '300'))  # Seconds between two metrics log lines, 0 to disable
+
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token and return 0, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class SendDispatcher(BaseRateLimiter):
+    """
+    Rate limiter every request of the bot goes through, set with
+    Application.builder().rate_limiter() or ExtBot(rate_limiter=...).
+
+    Requests to a chat first wait for the bucket of that chat, then queue for the
+    global bucket where interactive replies are let through before broadcasts.
+    A RetryAfter from Telegram pauses every send for the requested time before the
+    request is retried; transient network errors are retried with exponential backoff.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 group_rate=SEND_GROUP_RATE, max_retries=SEND_MAX_RETRIES, metrics_interval=SEND_METRICS_INTERVAL):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate / 60
+        self.max_retries = max_retries
+        self.metrics_interval = metrics_interval
+        self._chat_buckets = {}
+        self._waiting = []  # Heap of (priority, sequence, future) waiting for the global bucket
+        self._sequence = itertools.count()
+        self._waiting_for_chat = 0
+        self._paused_until = 0
+        self._latencies = deque(maxlen=1000)  # Milliseconds from the request to the answer of Telegram
+        self._counters = {'sent': 0, 'retried': 0, 'failed': 0}
+        self._wakeup = None
+        self._tasks = []
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        registry.gauge('telegram_send_queue_depth', lambda: len(self._waiting) + self._waiting_for_chat)
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        if self.metrics_interval:
+            self._tasks.append(asyncio.create_task(self._report()))
+
+    async def shutdown(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # getUpdates, setWebhook and friends are not sends
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get('priority', INTERACTIVE)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            await self._wait_for_chat(chat_id)
+            await self._wait_for_turn(priority)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                error = e
+                delay = _seconds(e.retry_after)
+                # Flood limits apply to the whole bot, so every send waits
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Telegram asked to wait {delay:.0f}s before {endpoint} to chat {chat_id}")
+            except (BadRequest, TimedOut):
+                # A bad request fails again, and a timed out one may have been delivered already
+                self._counters['failed'] += 1
+                registry.increment('telegram_sends_total', endpoint=endpoint, outcome='failed')
+                raise
+            except NetworkError as e:
+                error = e
+                delay = min(60, 2 ** attempt)
+                logger.warning(f"{endpoint} to chat {chat_id} failed ({e}), retrying in {delay}s")
+            except Exception:
+                self._counters['failed'] += 1
+                registry.increment('telegram_sends_total', endpoint=endpoint, outcome='failed')
+                raise
+            else:
+                elapsed = time.monotonic() - started
+                self._counters['sent'] += 1
+                self._latencies.append(elapsed * 1000)
+                registry.observe('telegram_send_seconds', elapsed, endpoint=endpoint)
+                registry.increment('telegram_sends_total', endpoint=endpoint, outcome='sent')
+                return result
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._counters['failed'] += 1
+                registry.increment('telegram_sends_total', endpoint=endpoint, outcome='failed')
+                raise error
+            self._counters['retried'] += 1
+            registry.increment('telegram_sends_total', endpoint=endpoint, outcome='retried')
+            await asyncio.sleep(delay)
+
+    def metrics(self):
+        """Queue depth, counters and latency percentiles of the sends."""
+        latencies = sorted(self._latencies)
+        pick = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1) if latencies else None
+        return {
+            'queue_depth': len(self._waiting),
+            'waiting_for_chat': self._waiting_for_chat,
+            'paused_for': max(0, round(self._paused_until - time.monotonic(), 1)),
+            'latency_p50_ms': pick(0.5),
+            'latency_p95_ms': pick(0.95),
+            **self._counters
+        }
+
+    async def _wait_for_chat(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            self._prune_chat_buckets()
+            # Group chats have negative ids and a much lower limit
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        self._waiting_for_chat += 1
+        try:
+            while True:
+                delay = bucket.take()
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            self._waiting_for_chat -= 1
+
+    async def _wait_for_turn(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self.global_bucket.take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            # Popped only now, so a reply queued while waiting for the token still goes before broadcasts
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                # The request was cancelled while waiting
+                self.global_bucket.give_back()
+                continue
+            future.set_result(None)
+
+    async def _report(self):
+        last_sent = None
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            metrics = self.metrics()
+            if metrics['sent'] != last_sent or metrics['queue_depth']:
+                logger.info(f"Send metrics: {metrics}")
+                last_sent = metrics['sent']
+
+    def _prune_chat_buckets(self):
+        if len(self._chat_buckets) < 10000:
+            return
+        now = time.monotonic()
+        # A bucket left alone for a minute is full again, so a new one is the same
+        for chat_id in [c for c, b in self._chat_buckets.items() if now - b.updated > 60]:
+            del self._chat_buckets[chat_id]
+
+
+def _seconds(retry_after):
+    # Newer python-telegram-bot versions give a timedelta instead of seconds
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
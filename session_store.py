@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Cookie fields accepted by WebDriver's add_cookie
+COOKIE_FIELDS = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly', 'expiry', 'sameSite')
+
+
+class SessionStore:
+    """
+    Saves the cookies and the web storage of a logged in browser on disk
+    and injects them into new browsers so that the login form can be skipped.
+    """
+
+    def __init__(self, path="sessions/session.json", max_age=12 * 3600):
+        self.path = path
+        self.max_age = max_age  # Seconds after which a saved session is not trusted anymore
+        self._lock = threading.Lock()
+
+    def save(self, driver):
+        """Store the authenticated state of the browser, which must be on the target site."""
+        session = {
+            'saved_at': time.time(),
+            'cookies': driver.get_cookies(),
+            'local_storage': driver.execute_script("return Object.assign({}, window.localStorage);"),
+            'session_storage': driver.execute_script("return Object.assign({}, window.sessionStorage);"),
+        }
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            # Write to a temporary file first so that a concurrent reader never sees half a session
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(session, f)
+            os.replace(tmp_path, self.path)
+        logger.debug(f"Session with {len(session['cookies'])} cookies saved on {self.path}")
+
+    def load(self):
+        """Return the saved session, or None if there is none or it has expired."""
+        with self._lock:
+            try:
+                with open(self.path) as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                return None
+
+        if self.max_age and time.time() - session.get('saved_at', 0) > self.max_age:
+            logger.debug("Saved session is too old, it will not be used")
+            return None
+
+        now = time.time()
+        cookies = [c for c in session.get('cookies', []) if c.get('expiry') is None or c['expiry'] > now]
+        if not cookies:
+            logger.debug("All the cookies of the saved session are expired")
+            return None
+        session['cookies'] = cookies
+        return session
+
+    def restore(self, driver, url):
+        """
+        Inject the saved session into the browser and reload `url`.
+        Returns False when there was nothing to inject; the caller still has to
+        check whether the site accepted the session.
+        """
+        session = self.load()
+        if session is None:
+            return False
+
+        # Cookies can only be added for the domain currently loaded in the browser
+        driver.get(url)
+        driver.delete_all_cookies()
+        for cookie in session['cookies']:
+            cookie = {k: v for k, v in cookie.items() if k in COOKIE_FIELDS}
+            if 'expiry' in cookie:
+                cookie['expiry'] = int(cookie['expiry'])
+            try:
+                driver.add_cookie(cookie)
+            except Exception as e:
+                logger.debug(f"Cookie {cookie.get('name')} rejected by the browser: {e}")
+
+        driver.execute_script("""
+            var local = arguments[0], session = arguments[1];
+            Object.keys(local).forEach(function(k) { window.localStorage.setItem(k, local[k]); });
+            Object.keys(session).forEach(function(k) { window.sessionStorage.setItem(k, session[k]); });
+        """, session.get('local_storage') or {}, session.get('session_storage') or {})
+        driver.get(url)
+        return True
+
+    def clear(self):
+        """Forget the saved session, e.g. after the site rejected it."""
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
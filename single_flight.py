@@ -0,0 +1,38 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs at most one job per key at a time.
+
+    Callers asking for a key which is already in flight wait for the running
+    job and all of them receive its result (or its exception).
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+
+    def is_in_flight(self, key):
+        return key in self._in_flight
+
+    async def do(self, key, func):
+        """Await `func()` or, if a job for `key` is already running, its result."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            logger.debug(f"Joining the job already in flight for {key}")
+        # Shielded so that a waiter going away does not cancel the job for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Retrieve the exception so that asyncio does not log it when no waiter is left
+            logger.debug(f"Job for {key} failed: {task.exception()}")
@@ -1,12 +1,30 @@
+import argparse
+import dataclasses
+import html
 import logging
 import os
+import threading
+import time
 import tracemalloc
 import asyncio
 from dotenv import load_dotenv
 from telegram import Update, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, CallbackQueryHandler, filters
-from script_selenium import ElementFinderSeleniumBot
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, CallbackQueryHandler, TypeHandler, filters
+from driver_pool import DriverPool
+from session_store import SessionStore
+from result_cache import ResultCache
+from single_flight import SingleFlight
+from result_sender import send_result, send_batch_results, send_cruise_results, send_degraded
+from circuit_breaker import CircuitBreaker, CircuitOpen
+from precompute_scheduler import PrecomputeScheduler, Subscriptions
+from scrape_executor import ScrapeExecutor, ScrapeCancelled, QueueFull
+from scrape_queue import SQLiteScrapeQueue, INTERACTIVE_PRIORITY
+from send_dispatcher import SendDispatcher, BROADCAST
+from file_id_cache import FileIdCache
+from screenshot_archive import ScreenshotArchive
+from request_profiles import check_profile
+from metrics import registry, start_metrics_server
 
 # Load the .env file
 load_dotenv()
@@ -17,15 +35,206 @@ logger = logging.getLogger(__name__)
 
 # Replace 'YOUR_API_TOKEN' with your actual API token
 API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')  # Another Bot API server, e.g. the fake one of the benchmark
 USER = os.getenv('USER')
 PASSWORD = os.getenv('PASSWORD')
 
-bot = ElementFinderSeleniumBot(USER, PASSWORD)
+HEADLESS = os.getenv('HEADLESS', 'true').lower() == 'true'
+DRIVER_POOL_SIZE = int(os.getenv('DRIVER_POOL_SIZE', '2'))  # Number of warm browsers kept logged in
+DRIVER_POOL_MAX_USES = int(os.getenv('DRIVER_POOL_MAX_USES', '20'))  # Recycle a browser after this many scrapes
+DRIVER_POOL_MAX_MEMORY_MB = int(os.getenv('DRIVER_POOL_MAX_MEMORY_MB', '512'))  # Recycle a browser above this JS heap size
+
+SESSION_FILE = os.getenv('SESSION_FILE', 'sessions/session.json')  # Where cookies and web storage of the login are kept
+SESSION_MAX_AGE = int(os.getenv('SESSION_MAX_AGE', str(12 * 3600)))  # Seconds after which the saved login is not reused
+
+PREWARM_BROWSERS = os.getenv('PREWARM_BROWSERS', 'true').lower() == 'true'  # Launch the pooled browsers while the bot connects
+
+# Shared by every scrape of the process, opened by a target site which keeps failing
+site_breaker = CircuitBreaker()
+
+bot = None  # ElementFinderSeleniumBot, created by get_bot() the first time a browser is needed
+bot_lock = threading.Lock()
+
+def get_bot():
+    """
+    Return the scraper, creating it on first use. Selenium and the scraper are only imported
+    here, so that the bot starts polling without waiting for them.
+    """
+    global bot
+    with bot_lock:
+        if bot is None:
+            from script_selenium import ElementFinderSeleniumBot
+            from driver_backends import create_backend_from_env
+            # Browsers are launched locally, or on the Selenium nodes listed in SELENIUM_REMOTE_URLS
+            bot = ElementFinderSeleniumBot(USER, PASSWORD, SessionStore(SESSION_FILE, max_age=SESSION_MAX_AGE),
+                                           request_profile=REQUEST_PROFILE, driver_backend=create_backend_from_env(),
+                                           circuit_breaker=site_breaker)
+        return bot
+
+driver_pool = DriverPool(
+    lambda: get_bot().create_logged_in_driver(headless=HEADLESS),
+    size=DRIVER_POOL_SIZE,
+    max_uses=DRIVER_POOL_MAX_USES,
+    max_memory_mb=DRIVER_POOL_MAX_MEMORY_MB,
+    destroy=lambda driver: get_bot().quit_driver(driver)
+)
+
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '600'))  # Seconds a screenshot is served from the cache
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '32'))  # Results kept in memory
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'cache/results')  # Where results are kept on disk, empty for memory only
+RESULT_CACHE_DISK_SIZE = int(os.getenv('RESULT_CACHE_DISK_SIZE', '256'))  # Results kept on disk
+
+result_cache = ResultCache(
+    ttl=RESULT_CACHE_TTL,
+    max_entries=RESULT_CACHE_SIZE,
+    disk_dir=RESULT_CACHE_DIR,
+    max_disk_entries=RESULT_CACHE_DISK_SIZE
+)
+
+SCRAPE_WORKERS = int(os.getenv('SCRAPE_WORKERS', str(DRIVER_POOL_SIZE)))  # Scrapes running at the same time
+SCRAPE_QUEUE_SIZE = int(os.getenv('SCRAPE_QUEUE_SIZE', '50'))  # Scrapes allowed to wait for a free worker
+
+scrape_executor = ScrapeExecutor(max_workers=SCRAPE_WORKERS, max_queue=SCRAPE_QUEUE_SIZE)
+scrapes_in_flight = SingleFlight()  # Identical searches running at the same time share one browser
+
+# 'inprocess' scrapes in this process, 'queue' leaves the scraping to scrape_worker.py processes
+SCRAPE_MODE = os.getenv('SCRAPE_MODE', 'inprocess').lower()
+SCRAPE_QUEUE_FILE = os.getenv('SCRAPE_QUEUE_FILE', 'data/scrape_queue.sqlite3')  # Job queue shared with the workers
+scrape_queue = SQLiteScrapeQueue(SCRAPE_QUEUE_FILE) if SCRAPE_MODE == 'queue' else None
+
+FILE_ID_CACHE_FILE = os.getenv('FILE_ID_CACHE_FILE', 'data/file_ids.json')  # Telegram file_id of the images already uploaded
+FILE_ID_CACHE_TTL = int(os.getenv('FILE_ID_CACHE_TTL', str(30 * 24 * 3600)))  # Seconds a file_id is reused
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '2000'))
+
+file_ids = FileIdCache(FILE_ID_CACHE_FILE, ttl=FILE_ID_CACHE_TTL, max_entries=FILE_ID_CACHE_SIZE)
+
+SCREENSHOT_ARCHIVE_DIR = os.getenv('SCREENSHOT_ARCHIVE_DIR', '')  # Folder keeping a copy of every new screenshot, empty to disable
+
+screenshot_archive = ScreenshotArchive(SCREENSHOT_ARCHIVE_DIR) if SCREENSHOT_ARCHIVE_DIR else None
+
+REQUEST_PROFILE = os.getenv('REQUEST_PROFILE', 'block_trackers')  # Requests blocked by the screenshot searches
+RESULTS_REQUEST_PROFILE = os.getenv('RESULTS_REQUEST_PROFILE', 'text_only')  # Requests blocked by the text only /results searches
+
+FRESH_FLAG = '--fresh'  # Argument of /screenshot which bypasses the result cache
+SCREENSHOT_BATCH_MAX = int(os.getenv('SCREENSHOT_BATCH_MAX', '5'))  # Combinations of a /screenshot_batch, one browser tab each
 
 VALID_SHIPS = ['MSC World Europa', 'MSC Seaside', 'MSC Meraviglia']  # Add your valid ship names here
 VALID_PORT_DEPARTURE = ['Genoa', 'Barcelona', 'Miami']  # Add your valid port of departure names here
 chosen_ship = None  # Global variable to store the chosen ship
 chosen_port = None  # Global variable to store the chosen port
+telegram_application = None  # Set once the Application is running, used to push updates outside of a handler
+
+SCHEDULER_OWNER = 'scheduler'  # Owner of the scrape jobs started by the PrecomputeScheduler
+PRECOMPUTE_ENABLED = os.getenv('PRECOMPUTE_ENABLED', 'true').lower() == 'true'
+PRECOMPUTE_INTERVAL = int(os.getenv('PRECOMPUTE_INTERVAL', str(RESULT_CACHE_TTL)))  # Seconds between refreshes of a requested combination
+PRECOMPUTE_MIN_INTERVAL = int(os.getenv('PRECOMPUTE_MIN_INTERVAL', '120'))  # Refresh interval of the most requested combinations
+SUBSCRIPTIONS_FILE = os.getenv('SUBSCRIPTIONS_FILE', 'data/subscriptions.json')
+
+subscriptions = Subscriptions(SUBSCRIPTIONS_FILE)
+precompute_scheduler = None  # PrecomputeScheduler, created when the Application starts
+
+# 'polling' asks Telegram for updates, 'webhook' lets Telegram post them to WEBHOOK_URL
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')  # Address the webhook server binds to
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')  # Path of the endpoint receiving the updates
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public https address of the server, WEBHOOK_PATH is appended to it
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')  # Updates without this X-Telegram-Bot-Api-Secret-Token are rejected
+HANDLER_TIMING = os.getenv('HANDLER_TIMING', 'false').lower() == 'true'  # Log how long every update took to handle
+
+update_started = {}  # update_id -> time the first handler group started, used by HANDLER_TIMING
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Port of the Prometheus /metrics endpoint, 0 to disable
+# Chats allowed to use /stats
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()}
+STATS_TOP_ALLOCATIONS = 10  # tracemalloc allocation sites shown by /stats
+
+registry.gauge('scrape_queue_depth', scrape_executor.queue_length)
+registry.gauge('scrapes_running', scrape_executor.running_count)
+registry.gauge('site_circuit_open', lambda: int(site_breaker.is_open()))
+
+async def read_ship_and_port(context: CallbackContext, chat_id, args):
+    """
+    Read the "ship_name-port_of_departure" argument of a command.
+    Returns None after telling the user what is wrong when it is missing or invalid.
+    """
+    # Ship names contain spaces, so the arguments are joined back before splitting on the last hyphen
+    if not args or '-' not in " ".join(args):
+        await context.bot.send_message(chat_id=chat_id, text="Please provide a ship name and a port of departure separated by a hyphen (-).")
+        return None
+
+    ship_name, port_of_departure = " ".join(args).rsplit('-', 1)
+    ship_name, port_of_departure = ship_name.strip(), port_of_departure.strip()
+
+    logger.debug(f"Read from user ==> Ship name: {ship_name} and Port of Departure: {port_of_departure}")
+
+    if ship_name not in VALID_SHIPS:
+        error_message = (
+            f"Invalid ship name: {ship_name}\n"
+            "Valid ship names are:\n" +
+            "\n".join(VALID_SHIPS)
+        )
+        await context.bot.send_message(chat_id=chat_id, text=error_message)
+        return None
+
+    if port_of_departure not in VALID_PORT_DEPARTURE:
+        error_message = (
+            f"Invalid port of departure: {port_of_departure}\n"
+            "Valid ports of departure are:\n" +
+            "\n".join(VALID_PORT_DEPARTURE)
+        )
+        await context.bot.send_message(chat_id=chat_id, text=error_message)
+        return None
+
+    return ship_name, port_of_departure
+
+def scrape_key(ship_name, port_of_departure, capture=True):
+    """Key of a search for the in-flight coalescing; text only searches never join a screenshot one."""
+    return (ship_name, port_of_departure) if capture else (ship_name, port_of_departure, 'text')
+
+async def scrape(ship_name, port_of_departure, chat_id=None, context: CallbackContext = None, capture=True):
+    """
+    Queue the search on the scrape executor and store the result in the cache.
+    Returns the job together with the result so that every waiter can check whether it still owns it.
+    Background refreshes pass no chat_id and are owned by the scheduler.
+    """
+    request_profile = None if capture else RESULTS_REQUEST_PROFILE
+    # The last result lets the scraper skip capturing and encoding a page which did not change
+    previous = await asyncio.to_thread(result_cache.latest, ship_name, port_of_departure) if capture else None
+    job = scrape_executor.submit(
+        lambda cancel_event: get_bot().run_scrape(ship_name, port_of_departure, headless=HEADLESS, driver_pool=driver_pool,
+                                            cancel_event=cancel_event, request_profile=request_profile, capture=capture,
+                                            previous=previous),
+        key=scrape_key(ship_name, port_of_departure, capture),
+        owner=chat_id if chat_id is not None else SCHEDULER_OWNER
+    )
+    position = scrape_executor.position(job)
+    if position > 0 and chat_id is not None:
+        await context.bot.send_message(chat_id=chat_id, text=f"Your search is number {position} in the queue. Send /cancel to cancel it.")
+    result = await job.future
+    result_cache.put(result)
+    if screenshot_archive is not None:
+        screenshot_archive.submit(result)
+    return job, result
+
+async def enqueue_scrape(ship_name, port_of_departure, chat_id, context: CallbackContext, capture=True):
+    """
+    Queue the search for the scraper workers, which send the result to the chat themselves.
+    """
+    job_id = await asyncio.to_thread(scrape_queue.enqueue, ship_name, port_of_departure, chat_id=chat_id,
+                                     requester=str(chat_id), priority=INTERACTIVE_PRIORITY, capture=capture)
+    position = await asyncio.to_thread(scrape_queue.position, job_id)
+    if position > 0:
+        await context.bot.send_message(chat_id=chat_id, text=f"Your search is number {position} in the queue. Send /cancel to cancel it.")
+
+async def reply_degraded(context: CallbackContext, chat_id, ship_name, port_of_departure, capture=True):
+    """
+    Answer without a browser while the circuit of the site is open
+    """
+    logger.info(f"Site degraded, answering {ship_name}-{port_of_departure} without scraping")
+    latest = await asyncio.to_thread(result_cache.latest, ship_name, port_of_departure, with_images=capture)
+    await send_degraded(context.bot, chat_id, ship_name, port_of_departure, latest, site_breaker.retry_after(),
+                        capture=capture, file_ids=file_ids)
 
 async def send_screenshot(update: Update, context: CallbackContext) -> None:
     """
@@ -48,40 +257,47 @@ async def send_screenshot(update: Update, context: CallbackContext) -> None:
             return
 
         logger.info(f'{user_first_name} wrote {user_text}')
-        
+        started = time.perf_counter()
+
+        args = context.args or []
+        fresh = FRESH_FLAG in args
+        args = [arg for arg in args if arg != FRESH_FLAG]
+
         if chosen_ship and chosen_port:
             ship_name = chosen_ship
             port_of_departure = chosen_port
         else:
-            if len(context.args) < 2:
-                await context.bot.send_message(chat_id=chat_id, text="Please provide a ship name and a port of departure separated by a hyphen (-).")
+            ship_and_port = await read_ship_and_port(context, chat_id, args)
+            if ship_and_port is None:
                 return
+            ship_name, port_of_departure = ship_and_port
 
-            ship_name, port_of_departure = context.args[0].split('-')
-
-            logger.debug(f"Read from user ==> Ship name: {ship_name} and Port of Departure: {port_of_departure}")
+        if precompute_scheduler is not None:
+            precompute_scheduler.record_demand((ship_name, port_of_departure))
 
-            if ship_name not in VALID_SHIPS:
-                error_message = (
-                    f"Invalid ship name: {ship_name}\n"
-                    "Valid ship names are:\n" +
-                    "\n".join(VALID_SHIPS)
-                )
-                await context.bot.send_message(chat_id=chat_id, text=error_message)
+        # Answer straight away when the same search was run recently, or was refreshed in the background
+        if not fresh:
+            result = await asyncio.to_thread(result_cache.get, ship_name, port_of_departure)
+            if result is not None:
+                logger.info(f"Serving {ship_name}-{port_of_departure} from the cache ({result.age():.0f}s old)")
+                await send_result(context.bot, chat_id, result, file_ids=file_ids)
+                registry.observe('reply_seconds', time.perf_counter() - started, command='screenshot', source='cache')
                 return
 
-            if port_of_departure not in VALID_PORT_DEPARTURE:
-                error_message = (
-                    f"Invalid port of departure: {port_of_departure}\n"
-                    "Valid ports of departure are:\n" +
-                    "\n".join(VALID_PORT_DEPARTURE)
-                )
-                await context.bot.send_message(chat_id=chat_id, text=error_message)
-                return
+        if site_breaker.is_open():
+            await reply_degraded(context, chat_id, ship_name, port_of_departure)
+            registry.observe('reply_seconds', time.perf_counter() - started, command='screenshot', source='degraded')
+            return
+
+        key = scrape_key(ship_name, port_of_departure)
+        if scrapes_in_flight.is_in_flight(key):
+            status_msg = "<b>The same search has just been started for another user, you will receive the same result.</b>\n\n"
+        else:
+            status_msg = "<b>Wait while the system generates a simulation for you...</b>\n\n"
 
         WelcomeMsg = (
             "<b>Welcome to the Cruises Finder Bot!</b> 🚢\n\n"
-            "<b>Wait while the system generates a simulation for you...</b>\n\n"
+            f"{status_msg}"
             f"<b>I'm looking for a cruise with Ship Name:</b> {ship_name} and <b>Port of Departure:</b> {port_of_departure}\n\n"
             "This process may take a few seconds, please be patient. 🕒"
         )
@@ -92,14 +308,310 @@ async def send_screenshot(update: Update, context: CallbackContext) -> None:
             parse_mode=ParseMode.HTML
         )
 
-        await bot.run_script_on_selenium(ship_name, port_of_departure)
+        if scrape_queue is not None:
+            await enqueue_scrape(ship_name, port_of_departure, chat_id, context)
+            return
 
-        # Get the screenshot path
-        screenshot_path = bot.get_screenshot_path()
+        # Join the job of the identical search already running, so that /cancel only drops this chat
+        running_job = scrape_executor.find(key)
+        if running_job is not None:
+            running_job.add_owner(chat_id)
+
+        try:
+            job, result = await scrapes_in_flight.do(key, lambda: scrape(ship_name, port_of_departure, chat_id, context))
+        except CircuitOpen:
+            await reply_degraded(context, chat_id, ship_name, port_of_departure)
+            return
+        except ScrapeCancelled:
+            await context.bot.send_message(chat_id=chat_id, text="Your search has been cancelled.")
+            return
+        except QueueFull:
+            await context.bot.send_message(chat_id=chat_id, text="Too many searches are waiting, please try again in a few minutes.")
+            return
+
+        if job.cancelled_by(chat_id):
+            # This chat cancelled the search while others were still waiting for it
+            return
 
         # Send the screenshot to the Telegram bot
-        with open(screenshot_path, 'rb') as photo:
-            await context.bot.send_photo(chat_id=chat_id, photo=photo)
+        await send_result(context.bot, chat_id, result, file_ids=file_ids)
+        registry.observe('reply_seconds', time.perf_counter() - started, command='screenshot', source='scrape')
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+
+async def send_screenshot_batch(update: Update, context: CallbackContext) -> None:
+    """
+    This function takes the screenshots of several ships at once, in the tabs of a single browser
+    """
+    chat_id = update.message.chat_id
+    try:
+        logger.info(f'{update.message.from_user.first_name} wrote {update.message.text}')
+        started = time.perf_counter()
+        args = context.args or []
+        fresh = FRESH_FLAG in args
+        pairs = [pair for pair in " ".join(arg for arg in args if arg != FRESH_FLAG).split(',') if pair.strip()]
+        if not pairs:
+            await context.bot.send_message(chat_id=chat_id, text="Please provide ship-port pairs separated by commas, "
+                                                                 "e.g. /screenshot_batch MSC World Europa-Genoa, MSC Seaside-Barcelona")
+            return
+        if len(pairs) > SCREENSHOT_BATCH_MAX:
+            await context.bot.send_message(chat_id=chat_id, text=f"Please ask for at most {SCREENSHOT_BATCH_MAX} ship-port pairs at once.")
+            return
+
+        combinations = []
+        for pair in pairs:
+            ship_and_port = await read_ship_and_port(context, chat_id, pair.split())
+            if ship_and_port is None:
+                return
+            if ship_and_port not in combinations:
+                combinations.append(ship_and_port)
+        if precompute_scheduler is not None:
+            for combination in combinations:
+                precompute_scheduler.record_demand(combination)
+
+        results = {}
+        if not fresh:
+            for combination in combinations:
+                result = await asyncio.to_thread(result_cache.get, *combination)
+                if result is not None:
+                    results[combination] = result
+        missing = [combination for combination in combinations if combination not in results]
+        failed = []
+
+        if missing and scrape_queue is not None:
+            # The workers run single searches, so each of them is answered on its own
+            await context.bot.send_message(chat_id=chat_id, text=f"Looking for {len(missing)} cruises, the screenshots will arrive one by one... 🕒")
+            for ship_name, port_of_departure in missing:
+                await enqueue_scrape(ship_name, port_of_departure, chat_id, context)
+            missing = []
+        elif missing and not site_breaker.is_open():
+            await context.bot.send_message(chat_id=chat_id, text=f"Looking for {len(missing)} cruises at the same time... 🕒")
+            previous = {combination: await asyncio.to_thread(result_cache.latest, *combination) for combination in missing}
+            try:
+                job = scrape_executor.submit(
+                    lambda cancel_event: get_bot().run_batch(missing, headless=HEADLESS, driver_pool=driver_pool,
+                                                             cancel_event=cancel_event, previous=previous),
+                    key=('batch', tuple(missing)),
+                    owner=chat_id
+                )
+                outcomes = await job.future
+            except CircuitOpen:
+                outcomes = None
+            except ScrapeCancelled:
+                await context.bot.send_message(chat_id=chat_id, text="Your search has been cancelled.")
+                return
+            except QueueFull:
+                await context.bot.send_message(chat_id=chat_id, text="Too many searches are waiting, please try again in a few minutes.")
+                return
+            if outcomes is not None:
+                for combination, outcome in zip(missing, outcomes):
+                    if isinstance(outcome, Exception):
+                        failed.append(combination)
+                        continue
+                    result_cache.put(outcome)
+                    if screenshot_archive is not None:
+                        screenshot_archive.submit(outcome)
+                    results[combination] = outcome
+                missing = []
+
+        if missing:
+            # The site is degraded: fall back to the last result of every combination, however old
+            for combination in missing:
+                latest = await asyncio.to_thread(result_cache.latest, *combination)
+                if latest is not None and latest.images:
+                    results[combination] = latest
+                else:
+                    failed.append(combination)
+            await context.bot.send_message(chat_id=chat_id, text="The cruise site is not responding at the moment, these are the last results taken.")
+
+        if results:
+            await send_batch_results(context.bot, chat_id, [results[c] for c in combinations if c in results], file_ids=file_ids)
+        if failed:
+            await context.bot.send_message(chat_id=chat_id, text="Unable to take the screenshot of: " +
+                                           ", ".join(f"{ship_name}-{port_of_departure}" for ship_name, port_of_departure in failed))
+        registry.observe('reply_seconds', time.perf_counter() - started, command='screenshot_batch', source='batch')
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+
+async def send_results(update: Update, context: CallbackContext) -> None:
+    """
+    This function replies with the cruises of the specified ship as text, read from the responses of the site
+    """
+    chat_id = update.message.chat_id
+    try:
+        logger.info(f'{update.message.from_user.first_name} wrote {update.message.text}')
+        args = context.args or []
+        fresh = FRESH_FLAG in args
+        ship_and_port = await read_ship_and_port(context, chat_id, [arg for arg in args if arg != FRESH_FLAG])
+        if ship_and_port is None:
+            return
+        ship_name, port_of_departure = ship_and_port
+
+        result = None if fresh else await asyncio.to_thread(result_cache.get, ship_name, port_of_departure, with_images=False)
+        if result is None and site_breaker.is_open():
+            await reply_degraded(context, chat_id, ship_name, port_of_departure, capture=False)
+            return
+        if result is None:
+            await context.bot.send_message(chat_id=chat_id, text=f"Looking for the cruises of {ship_name} from {port_of_departure}... 🕒")
+            if scrape_queue is not None:
+                await enqueue_scrape(ship_name, port_of_departure, chat_id, context, capture=False)
+                return
+            key = scrape_key(ship_name, port_of_departure, capture=False)
+            running_job = scrape_executor.find(key)
+            if running_job is not None:
+                running_job.add_owner(chat_id)
+            try:
+                job, result = await scrapes_in_flight.do(key, lambda: scrape(ship_name, port_of_departure, chat_id, context, capture=False))
+            except CircuitOpen:
+                await reply_degraded(context, chat_id, ship_name, port_of_departure, capture=False)
+                return
+            except ScrapeCancelled:
+                await context.bot.send_message(chat_id=chat_id, text="Your search has been cancelled.")
+                return
+            except QueueFull:
+                await context.bot.send_message(chat_id=chat_id, text="Too many searches are waiting, please try again in a few minutes.")
+                return
+            if job.cancelled_by(chat_id):
+                return
+
+        await send_cruise_results(context.bot, chat_id, result)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+
+async def refresh_in_background(ship_name, port_of_departure):
+    """
+    Refresh a combination for the PrecomputeScheduler, joining an identical search already running.
+    In queue mode the refresh is queued for the workers, which push it to the subscribers, and None is returned.
+    """
+    if scrape_queue is not None:
+        job_id = await asyncio.to_thread(scrape_queue.enqueue, ship_name, port_of_departure)
+        for chat_id in subscriptions.chats_for((ship_name, port_of_departure)):
+            await asyncio.to_thread(scrape_queue.enqueue, ship_name, port_of_departure, chat_id=chat_id,
+                                    only_if_changed=True)
+        logger.debug(f"Background refresh of {ship_name}-{port_of_departure} queued as job {job_id}")
+        return None
+    if site_breaker.is_open():
+        # The refreshes due once the circuit half opens are its probes
+        logger.debug(f"Site degraded, skipping the refresh of {ship_name}-{port_of_departure}")
+        return None
+    key = scrape_key(ship_name, port_of_departure)
+    running_job = scrape_executor.find(key)
+    if running_job is not None:
+        running_job.add_owner(SCHEDULER_OWNER)
+    previous = await asyncio.to_thread(result_cache.latest, ship_name, port_of_departure)
+    _, result = await scrapes_in_flight.do(key, lambda: scrape(ship_name, port_of_departure))
+    from change_detection import highlight_changes, CHANGE_HIGHLIGHT  # Loads Pillow, only needed by the refreshes
+    if result.changed and CHANGE_HIGHLIGHT and previous is not None and previous.images:
+        # Only the pushed copy is highlighted, the cache keeps the plain images to compare the next refresh with
+        images = await asyncio.to_thread(highlight_changes, previous.images, result.images, result.image_format)
+        result = dataclasses.replace(result, images=images)
+    return result
+
+async def push_to_subscribers(result) -> None:
+    """
+    Send a refreshed result to the chats subscribed to its combination, unless the page did not change
+    """
+    if not result.changed:
+        logger.debug(f"{result.key} did not change, nothing to push")
+        return
+    async def push(chat_id):
+        try:
+            await send_result(telegram_application.bot, chat_id, result, priority=BROADCAST, file_ids=file_ids)
+        except Exception as e:
+            logger.error(f"Unable to push {result.key} to chat {chat_id}: {e}")
+    chats = list(subscriptions.chats_for(result.key))
+    if not chats:
+        return
+    # The first send uploads the images, the others reuse their file_ids;
+    # the SendDispatcher paces them, interactive replies keep going first
+    await push(chats[0])
+    await asyncio.gather(*(push(chat_id) for chat_id in chats[1:]))
+
+async def subscribe(update: Update, context: CallbackContext) -> None:
+    chat_id = update.message.chat_id
+    try:
+        ship_and_port = await read_ship_and_port(context, chat_id, context.args or [])
+        if ship_and_port is None:
+            return
+        subscriptions.subscribe(ship_and_port, chat_id)
+        ship_name, port_of_departure = ship_and_port
+        await context.bot.send_message(chat_id=chat_id, text=f"You will receive the updates of {ship_name} from {port_of_departure}. Send /unsubscribe {ship_name}-{port_of_departure} to stop them.")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+
+async def unsubscribe(update: Update, context: CallbackContext) -> None:
+    chat_id = update.message.chat_id
+    try:
+        if not context.args:
+            subscribed = subscriptions.keys_for(chat_id)
+            if subscribed:
+                text = "Your subscriptions are:\n" + "\n".join(f"{ship}-{port}" for ship, port in subscribed)
+            else:
+                text = "You have no subscriptions."
+            await context.bot.send_message(chat_id=chat_id, text=text)
+            return
+        ship_and_port = await read_ship_and_port(context, chat_id, context.args)
+        if ship_and_port is None:
+            return
+        if subscriptions.unsubscribe(ship_and_port, chat_id):
+            text = "You will not receive these updates anymore."
+        else:
+            text = "You are not subscribed to these updates."
+        await context.bot.send_message(chat_id=chat_id, text=text)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
+
+async def cancel_screenshot(update: Update, context: CallbackContext) -> None:
+    try:
+        if scrape_queue is not None:
+            cancelled = await asyncio.to_thread(scrape_queue.remove_chat, update.message.chat_id)
+        else:
+            cancelled = scrape_executor.cancel_for_owner(update.message.chat_id)
+        if cancelled:
+            text = "Your search has been cancelled."
+        else:
+            text = "You have no search waiting."
+        await context.bot.send_message(chat_id=update.message.chat_id, text=text)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Something went wrong. Please try again later.")
+
+def format_stats():
+    """Timers, counters and gauges of the registry plus the top tracemalloc allocation sites, as HTML."""
+    def series(name, labels):
+        return html.escape(f"{name}{{{','.join(f'{key}={value}' for key, value in labels)}}}")
+
+    lines = ["<b>Timers</b> (count: p50 / p95 / p99 seconds)"]
+    for (name, labels), (count, _, quantiles) in sorted(registry.summaries().items()):
+        lines.append(f"{series(name, labels)} {count}: " + " / ".join(f"{value:.2f}" for value in quantiles.values()))
+    lines.append("\n<b>Counters</b>")
+    for (name, labels), value in sorted(registry.counters().items()):
+        lines.append(f"{series(name, labels)} {value}")
+    lines.append("\n<b>Gauges</b>")
+    lines.extend(f"{html.escape(name)} {value}" for name, value in sorted(registry.gauges().items()))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"\n<b>Memory</b> {current / 1024 / 1024:.1f} MB traced, {peak / 1024 / 1024:.1f} MB peak")
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:STATS_TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            lines.append(html.escape(f"{os.path.basename(frame.filename)}:{frame.lineno} {stat.size / 1024:.0f} KB in {stat.count} blocks"))
+    text = "\n".join(lines)
+    # Telegram messages are limited to 4096 characters
+    return text if len(text) <= 4000 else text[:text.rfind("\n", 0, 4000)] + "\n..."
+
+async def show_stats(update: Update, context: CallbackContext) -> None:
+    chat_id = update.message.chat_id
+    try:
+        if chat_id not in ADMIN_CHAT_IDS:
+            await context.bot.send_message(chat_id=chat_id, text="Invalid command. Please choose a valid option from the menu.")
+            return
+        text = await asyncio.to_thread(format_stats)
+        await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         await context.bot.send_message(chat_id=chat_id, text="Something went wrong. Please try again later.")
@@ -109,8 +621,15 @@ async def show_help(update: Update, context: CallbackContext) -> None:
         help_text = (
             "Available commands:\n"
             "<b>/screenshot [ship_name-port_of_departure] - Take a screenshot of the specified ship and port of departure, and send it to the chat</b>\n"
-            "<i> Example: /screenshot MSC World Europa-Genoa</i>\n\n"
+            "<i> Example: /screenshot MSC World Europa-Genoa</i>\n"
+            "<i> Add --fresh to skip the results taken in the last minutes: /screenshot MSC World Europa-Genoa --fresh</i>\n\n"
             "keep in mind that if you don't provide the ship name and port of departure, you will be prompted to select them from a menu.\n\n"
+            "<b>/screenshot_batch [ship_name-port_of_departure, ...] - Take the screenshots of several ships at once, sent as a single album</b>\n"
+            "<i> Example: /screenshot_batch MSC World Europa-Genoa, MSC Seaside-Barcelona</i>\n\n"
+            "<b>/results [ship_name-port_of_departure] - Reply with the cruises of the specified ship and port of departure as text</b>\n"
+            "<b>/subscribe [ship_name-port_of_departure] - Receive a new screenshot every time the cruises are refreshed</b>\n"
+            "<b>/unsubscribe [ship_name-port_of_departure] - Stop the updates, without arguments list your subscriptions</b>\n"
+            "<b>/cancel - Cancel your search waiting in the queue</b>\n"
             "<b>/help - Show this help message</b>\n"
             "<b>/validships - Show the valid ship names</b>\n"
             "<b>/validports - Show the valid port of departure names</b>\n"
@@ -194,11 +713,81 @@ async def invalid_command(update: Update, context: CallbackContext) -> None:
         logger.error(f"An error occurred: {e}")
         await context.bot.send_message(chat_id=update.message.chat_id, text="Something went wrong. Please try again later.")
 
+async def start_update_timer(update: Update, context: CallbackContext) -> None:
+    update_started[update.update_id] = time.perf_counter()
+
+async def log_update_time(update: Update, context: CallbackContext) -> None:
+    started = update_started.pop(update.update_id, None)
+    if started is not None:
+        logger.info(f"Update {update.update_id} handled in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+async def start_background_services(application: Application) -> None:
+    global telegram_application, precompute_scheduler
+    telegram_application = application
+    scrape_executor.start()
+    if scrape_queue is None and PREWARM_BROWSERS:
+        # Launch and log in the pooled browsers while the bot starts polling, a request
+        # arriving before they are ready waits for the first one
+        threading.Thread(target=driver_pool.warm, name='driver-prewarm', daemon=True).start()
+    if PRECOMPUTE_ENABLED:
+        precompute_scheduler = PrecomputeScheduler(
+            [(ship, port) for ship in VALID_SHIPS for port in VALID_PORT_DEPARTURE],
+            refresh_in_background,
+            on_result=push_to_subscribers,
+            subscriptions=subscriptions,
+            base_interval=PRECOMPUTE_INTERVAL,
+            min_interval=PRECOMPUTE_MIN_INTERVAL
+        )
+        precompute_scheduler.start()
+
+async def stop_background_services(application: Application) -> None:
+    if precompute_scheduler is not None:
+        await precompute_scheduler.stop()
+    await scrape_executor.shutdown()
+    await asyncio.to_thread(result_cache.close)
+    if screenshot_archive is not None:
+        await asyncio.to_thread(screenshot_archive.close)
+
 def main() -> None:
-    tracemalloc.start()  # Enable tracemalloc
-    application = Application.builder().token(API_TOKEN).build()
+    parser = argparse.ArgumentParser(description="Cruises Finder Telegram bot")
+    parser.add_argument('--webhook', action='store_true', default=BOT_MODE == 'webhook',
+                        help="Receive the updates on a webhook instead of polling (BOT_MODE=webhook)")
+    args = parser.parse_args()
+    # Mistyped profiles would otherwise fail every scrape and open the circuit breaker
+    check_profile(REQUEST_PROFILE)
+    check_profile(RESULTS_REQUEST_PROFILE)
+
+    tracemalloc.start()  # Enable tracemalloc, the top allocation sites are shown by /stats
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    # Updates are handled concurrently so that /help and the menus answer while screenshots are running
+    application = (
+        Application.builder()
+        .token(API_TOKEN)
+        .base_url(TELEGRAM_BASE_URL)
+        .concurrent_updates(True)
+        .rate_limiter(SendDispatcher())  # Every request to Telegram is paced and retried by the dispatcher
+        .post_init(start_background_services)
+        .post_shutdown(stop_background_services)
+        .build()
+    )
+    if HANDLER_TIMING:
+        # Groups run in order for every update, so these wrap all the other handlers
+        application.add_handler(TypeHandler(Update, start_update_timer), group=-1)
+        application.add_handler(TypeHandler(Update, log_update_time), group=1)
     # Register the send_screenshot command
     application.add_handler(CommandHandler("screenshot", send_screenshot))
+    # Register the batch screenshot command handler
+    application.add_handler(CommandHandler("screenshot_batch", send_screenshot_batch))
+    # Register the results command
+    application.add_handler(CommandHandler("results", send_results))
+    # Register the subscription commands
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    # Register the cancel command
+    application.add_handler(CommandHandler("cancel", cancel_screenshot))
+    # Register the stats command, only answered to ADMIN_CHAT_IDS
+    application.add_handler(CommandHandler("stats", show_stats))
     # Register the help command
     application.add_handler(CommandHandler("help", show_help))
     # Register the valid ships command
@@ -215,10 +804,25 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(port_button_tap, pattern="^port:"))
     # Register the invalid command handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, invalid_command))
-    # Start the Bot
-    application.run_polling()
-    # Run the bot until you press Ctrl-C
-    application.idle()
+    try:
+        # Start the Bot
+        if args.webhook:
+            if not WEBHOOK_URL:
+                raise SystemExit("WEBHOOK_URL must be set to run the bot in webhook mode")
+            if not WEBHOOK_SECRET_TOKEN:
+                logger.warning("WEBHOOK_SECRET_TOKEN is not set, anybody knowing the URL can post updates")
+            # Stops on SIGINT/SIGTERM, letting the running handlers finish before post_shutdown
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN
+            )
+        else:
+            application.run_polling()
+    finally:
+        driver_pool.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
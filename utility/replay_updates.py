@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+
+# Replays recorded Telegram updates against the webhook of telegram_bot_conn.py (BOT_MODE=webhook).
+# The updates file holds one update per line, or a JSON list like the result of getUpdates.
+# Start the bot with HANDLER_TIMING=true and its log redirected to a file, then pass that file
+# as --bot-log to also get how long the handlers took for the replayed updates.
+
+load_dotenv()
+
+WEBHOOK_PORT = os.getenv('WEBHOOK_PORT', '8443')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+
+
+def load_updates(path):
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    data = [json.loads(line) for line in content.splitlines() if line.strip()]
+    # A saved getUpdates response wraps the updates in "result"
+    if len(data) == 1 and isinstance(data[0], dict) and 'result' in data[0]:
+        return data[0]['result']
+    return data
+
+
+def post_update(url, update, secret_token):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    started = time.perf_counter()
+    response = requests.post(url, json=update, headers=headers, timeout=30)
+    return response.status_code, (time.perf_counter() - started) * 1000
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "no samples"
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return (f"n={len(values)} mean={statistics.mean(values):.1f} p50={pick(0.5):.1f} "
+            f"p95={pick(0.95):.1f} p99={pick(0.99):.1f} max={values[-1]:.1f} ms")
+
+
+def handler_times(log_path, update_ids, wait):
+    """Read the 'Update N handled in X ms' lines logged by the bot for the replayed updates."""
+    pattern = re.compile(r"Update (\d+) handled in ([\d.]+) ms")
+    deadline = time.monotonic() + wait
+    found = {}
+    while True:
+        with open(log_path) as f:
+            for line in f:
+                match = pattern.search(line)
+                if match and int(match.group(1)) in update_ids:
+                    found[int(match.group(1))] = float(match.group(2))
+        if len(found) == len(update_ids) or time.monotonic() >= deadline:
+            return found
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the bot webhook")
+    parser.add_argument('updates', help="File with the recorded updates")
+    parser.add_argument('--url', default=f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}", help="Webhook endpoint")
+    parser.add_argument('--secret-token', default=WEBHOOK_SECRET_TOKEN)
+    parser.add_argument('--repeat', type=int, default=1, help="Times the updates are replayed")
+    parser.add_argument('--concurrency', type=int, default=1, help="Updates posted at the same time")
+    parser.add_argument('--bot-log', help="Log file of the bot started with HANDLER_TIMING=true")
+    parser.add_argument('--wait', type=float, default=120, help="Seconds to wait for the handlers to finish")
+    args = parser.parse_args()
+
+    recorded = load_updates(args.updates)
+    # Every replayed update gets a new id, the bot would otherwise mix up the timings of the copies
+    first_id = int(time.time() * 1000)
+    updates = []
+    for i in range(args.repeat * len(recorded)):
+        update = dict(recorded[i % len(recorded)])
+        update['update_id'] = first_id + i
+        updates.append(update)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        replies = list(pool.map(lambda update: post_update(args.url, update, args.secret_token), updates))
+    elapsed = time.perf_counter() - started
+
+    rejected = [status for status, _ in replies if status != 200]
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.1f}/s), {len(rejected)} rejected")
+    print(f"Webhook response: {percentiles([ms for status, ms in replies if status == 200])}")
+
+    if args.bot_log:
+        found = handler_times(args.bot_log, {update['update_id'] for update in updates}, args.wait)
+        print(f"Handlers: {percentiles(list(found.values()))}")
+        if len(found) < len(updates):
+            print(f"{len(updates) - len(found)} updates were not handled within {args.wait:.0f}s")
+
+
+if __name__ == '__main__':
+    main()